@@ -1,5 +1,7 @@
+import asyncio
 import shutil
 import subprocess
+import tempfile
 from datetime import datetime
 import os
 from pathlib import Path
@@ -14,18 +16,24 @@ import ee
 from starlette.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 
-from utils.create_zip import createZip
+from utils.inference_service import InferenceService
+from utils.job_queue import JobQueue
+from utils.result_cache import ResultCache
 from utils.ee_downloader import eeDownloader
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
 import io
 import zipfile
+from concurrent.futures import CancelledError
 from utils.geo_utils import *
+from utils.geo_utils import _releaseDatasets
 from fastapi.responses import FileResponse
 from utils.lang_segment_anything import *
 from utils.yolo_segment_anything import *
 from utils.statistics_download_img import get_image_info
 from utils.statistics_mask import analyze_mask
+from utils.tile_server import TileServer
 from mysql.connector import pooling, Error
 ee.Initialize()
 
@@ -143,9 +151,12 @@ async def ee_download(config: dict):
         return {"file": strPath}
     imgPath = os.path.join(UPLOAD_DIRECTORY, strPath)
     obj_manager = ImageManager()
-    obj_manager.readImg(imgPath)
-    obj_manager.truncatedLinearStretch(dblPercentile=2)
-    obj_manager.saveImg('./assets', obj_manager.dictConvertedImages, '.tif', formEE=True)
+    obj_manager.readImg(imgPath, lazy=True, strNormalize='native')
+    try:
+        obj_manager.truncatedLinearStretch(dblPercentile=2)
+        obj_manager.saveImg('./assets', obj_manager.dictConvertedImages, '.tif', formEE=True, isCOG=True)
+    finally:
+        obj_manager.close()
     current_date = datetime.now().strftime("%Y年%m月%d日 %H时%M分%S秒") 
   # 生成日期字符串
      # 新增数据库日志记录
@@ -259,6 +270,32 @@ async def get_thumbnail(filename: str):
         raise HTTPException(status_code=404, detail=str(e))
 
 
+# 影像切片服务（像素坐标金字塔），前端可按需逐级浏览大幅影像
+tile_server = TileServer("./assets/")
+
+
+@app.get("/tiles/{filename}/info")
+async def get_tile_info(filename: str):
+    try:
+        dictInfo = await run_in_threadpool(tile_server.getInfo, filename)
+    except (FileNotFoundError, RuntimeError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {key: dictInfo[key] for key in ["width", "height", "tileSize", "maxZoom"]}
+
+
+@app.get("/tiles/{filename}/{z}/{x}/{y}.{ext}")
+async def get_tile(filename: str, z: int, x: int, y: int, ext: str):
+    if ext not in ["png", "webp"]:
+        raise HTTPException(status_code=400, detail="仅支持 png 和 webp 切片")
+    try:
+        bytesTile = await run_in_threadpool(tile_server.getTile, filename, z, x, y, ext)
+    except (FileNotFoundError, RuntimeError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if bytesTile is None:
+        raise HTTPException(status_code=404, detail="切片超出影像范围")
+    return Response(content=bytesTile, media_type=f"image/{ext}")
+
+
 
 @app.post("/uploadPth")
 async def upload_weights(file: UploadFile = File(...)):
@@ -267,11 +304,11 @@ async def upload_weights(file: UploadFile = File(...)):
     if not file:
         raise HTTPException(status_code=400, detail="未找到上传的文件")
 
-    # 获取文件扩展名并检查是否为 .pth 文件
+    # 获取文件扩展名并检查是否为 .pth 或 .onnx 文件（量化模型以.onnx上传）
     filename = file.filename
     ext = os.path.splitext(filename)[1].lower()
-    if ext != '.pth':
-        raise HTTPException(status_code=400, detail="仅支持 .pth 文件上传")
+    if ext not in ['.pth', '.onnx']:
+        raise HTTPException(status_code=400, detail="仅支持 .pth 或 .onnx 文件上传")
 
     # 确保上传目录存在
     if not os.path.exists(UPLOAD_DIRECTORY):
@@ -301,38 +338,79 @@ async def upload_weights(file: UploadFile = File(...)):
     return {"info": f"文件 '{new_filename}' 已成功上传", "filename": new_filename}
 
 
-@app.post("/predict")
-async def predict(config: dict):
+# 常驻预测进程池，第一次预测时启动
+inference_service = InferenceService()
+# 异步预测任务队列，按模型类型限制并发，未列出的模型使用default
+job_queue = JobQueue({"LangSAM": 1, "YoloSAM": 1, "default": 1})
+# 预测结果缓存，同一影像、模型、权重和参数的重复预测直接返回上次的结果
+# 恢复缓存的结果文件前释放切片服务和ImageManager打开的句柄，Windows上才能替换文件
+result_cache = ResultCache("./assets/.result_cache", intBudgetBytes=2 * 1024 ** 3, funcRelease=_releaseDatasets)
+
+
+@app.on_event("shutdown")
+async def close_inference_service():
+    job_queue.shutdown()
+    inference_service.close()
+
+
+def predictionCacheKey(config, strPath):
+    """预测结果缓存键：影像文件名与内容、模型、权重文件内容以及所有影响输出的参数
+    结果文件按源文件名命名，因此文件名也计入键，内容相同的不同文件不会拿到彼此的结果文件"""
+    if config['ModelName'] in ['LangSAM', 'YoloSAM']:
+        listWeights = []
+    elif config.get('Weights'):
+        listWeights = [os.path.join("./assets/", config['Weights'])]
+    else:
+        # 默认权重按模型名和提取类型命名，全部计入以免替换权重后命中旧结果
+        strDefaultDir = "./utils/ModelTrainer/defaultModelWeights"
+        listWeights = [os.path.join(strDefaultDir, strName) for strName in os.listdir(strDefaultDir)
+                       if strName.startswith(config['ModelName'] + '_')]
+    dictParams = {"file": config['FileName'], "model": config['ModelName'], "extraction": config['Extraction'],
+                  "palette": config.get('Palette'), "backend": config.get('Backend') or 'torch',
+                  "tile_size": config.get('TileSize') or 512, "tile_step": config.get('TileStep') or 256,
+                  "attention": config.get('Attention') or 'sdpa'}
+    return result_cache.makeKey(strPath, listWeights, dictParams)
+
+
+def runPrediction(config, funcProgress=None, eventCancel=None):
+    """同步执行一次预测（在线程池中调用，不阻塞事件循环），返回{"Mixture": ..., "Origin": ...}
+    funcProgress(阶段, 已完成数, 总数)接收进度；LangSAM和YoloSAM不能中途取消，只在开始前检查eventCancel"""
+    funcProgress = funcProgress or (lambda *args: None)
     IMAGE_DIRECTORY = "./assets/"
+    funcProgress("prepare", 0, 1)
+    strPath = os.path.join(IMAGE_DIRECTORY, config['FileName'])
+    # 在翻译提取类型和加载模型之前查缓存
+    strCacheKey = predictionCacheKey(config, strPath)
+    dictCached = result_cache.get(strCacheKey, IMAGE_DIRECTORY)
+    if dictCached is not None:
+        funcProgress("cached", 1, 1)
+        return dictCached
+
+    dictResult = predictUncached(config, strPath, funcProgress, eventCancel)
+    try:
+        result_cache.put(strCacheKey, IMAGE_DIRECTORY, dictResult)
+    except OSError as e:
+        print(f"预测结果缓存失败: {str(e)}")
+    return dictResult
+
+
+def predictUncached(config, strPath, funcProgress, eventCancel):
     strExtractType = ts.translate_text(config['Extraction'], from_language='zh', to_language='en')
     print(strExtractType)
-    strPath = os.path.join(IMAGE_DIRECTORY, config['FileName'])
-    pilImage = Image.open(strPath).convert("RGB")
-    if config['ModelName'] == 'LangSAM':
-        strOrigin, strMixture =  predictAndSave(pilImage, strExtractType, config['FileName'])
-        return {"Mixture": strMixture, "Origin": strOrigin}
-    elif config['ModelName'] == 'YoloSAM':
-        strOrigin, strMixture = yoloWithSam("seg", "text", 0.25, pilImage, config['FileName'], strExtractType)
+    if config['ModelName'] in ['LangSAM', 'YoloSAM']:
+        pilImage = Image.open(strPath).convert("RGB")
+        if eventCancel is not None and eventCancel.is_set():
+            raise CancelledError()
+        funcProgress("predict", 0, 1)
+        if config['ModelName'] == 'LangSAM':
+            strOrigin, strMixture = predictAndSave(pilImage, strExtractType, config['FileName'])
+        else:
+            strOrigin, strMixture = yoloWithSam("seg", "text", 0.25, pilImage, config['FileName'], strExtractType)
+        funcProgress("predict", 1, 1)
         return {"Mixture": strMixture, "Origin": strOrigin}
 
-    strFilePath = Path(config['FileName'])
-    strFileName = strFilePath.stem + ".zip"
-
-    if config['Weights'] is None:
-        zip = createZip('./utils/ModelTrainer', [strPath], config)
-    else:
-        pthPath = os.path.join(IMAGE_DIRECTORY, config['Weights'])
-        Paths = [pthPath, strPath]
-        zip = createZip('./utils/ModelTrainer', Paths, config)
-    SAVE_DIRECTORY = "./temp/"
-    strSavePath = os.path.join(SAVE_DIRECTORY, strFileName)
-    RET_DIRECTORY = "./temp/" + Path(strFileName).stem
-    RUN_DIRECTORY = "./temp/" + Path(strFileName).stem + '/predictor.py'
-    with open(strSavePath, 'wb') as f:
-        f.write(zip.getbuffer())
-    zipFile = zipfile.ZipFile(strSavePath)
-    zipFile.extractall(path=RET_DIRECTORY)
-    subprocess.run(['python', 'predictor.py'], cwd=RET_DIRECTORY)
+    # 常驻预测进程中已缓存模型，不再打包ModelTrainer并启动新进程
+    dictResult = inference_service.predict(config, strPath, funcProgress, eventCancel)
     current_date = datetime.now().strftime("%Y年%m月%d日 %H时%M分%S秒") 
   # 生成日期字符串
      # 新增数据库日志记录
@@ -340,10 +418,54 @@ async def predict(config: dict):
         log_to_database(f"{current_date} 开始预测")  # 调用日志记录函数
     except Error as e:
         print(f"日志记录失败: {str(e)}")
-    if strFilePath.suffix == '.tif':
-        return {"Mixture": strFilePath.stem + '_mix.png', "Origin": strFilePath.stem + '_ori.tif'}
-    else:
-        return {"Mixture": strFilePath.stem + '_mix.png', "Origin": strFilePath.stem + '_ori.png'}
+    return dictResult
+
+
+@app.post("/predict")
+async def predict(config: dict):
+    # 同步接口同样经过任务队列，与/jobs/predict共用按模型划分的并发限制，等待期间不占用线程池
+    job = job_queue.submit(config['ModelName'], lambda job, dictConfig: runPrediction(
+        dictConfig, job.setProgress, job.eventCancel), config)
+    await asyncio.wrap_future(job.future)
+    if job.strStatus != "succeeded":
+        raise HTTPException(status_code=500, detail=f"预测失败: {job.strError or job.strStatus}")
+    return job.result
+
+
+@app.post("/jobs/predict")
+async def submit_predict_job(config: dict):
+    # 立即返回任务编号，预测在后台线程池中执行
+    job = job_queue.submit(config['ModelName'], lambda job, dictConfig: runPrediction(
+        dictConfig, job.setProgress, job.eventCancel), config)
+    return {"job_id": job.strJobId, "status": job.strStatus}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.toDict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    # Server-Sent Events：每当阶段或切片进度变化时推送一次，任务结束后关闭
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return StreamingResponse(job_queue.iterEvents(job), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.toDict()
+
+
 @app.get("/download/")
 async def download_file(filename: str):
     IMAGE_DIRECTORY = "./assets/"
@@ -379,8 +501,8 @@ async def get_info(filename: str):
 async def get_Mask_info(filename: str):
     IMAGE_DIRECTORY = "./assets/"
     file_path = os.path.join( IMAGE_DIRECTORY, filename)
-    IMG = cv2.imread(file_path)
-    info = analyze_mask(IMG)
+    # 缓存的预测结果只统计一次
+    info = result_cache.getMaskStats(file_path, lambda: analyze_mask(cv2.imread(file_path)))
     current_date = datetime.now().strftime("%Y年%m月%d日 %H时%M分%S秒") 
   # 生成日期字符串
      # 新增数据库日志记录
@@ -414,7 +536,7 @@ async def save_GeoTiff(data: dict):
 
     # 保存带有地理信息的图像为 GeoTiff 文件
     savePath = os.path.join(IMAGE_DIRECTORY, f"{oriFileName}")
-    obj_manager.saveImg('assets', obj_manager.dictGeoReferencedImages, '.tif', formEE=True)
+    obj_manager.saveImg('assets', obj_manager.dictGeoReferencedImages, '.tif', formEE=True, isCOG=True)
     current_date = datetime.now().strftime("%Y年%m月%d日 %H时%M分%S秒") 
   # 生成日期字符串
      # 新增数据库日志记录
@@ -431,29 +553,31 @@ async def save_ShpFile(data: dict):
     filename = data.get('filename')
     IMAGE_DIRECTORY = "./assets/"
     filename_base = Path(filename).stem
+    # 可选输出格式：shp(默认)、gpkg、fgb
+    dictFormats = {"shp": "ESRI Shapefile", "gpkg": "GPKG", "fgb": "FlatGeobuf"}
+    strFormat = data.get('format', 'shp')
+    if strFormat not in dictFormats:
+        raise HTTPException(status_code=400, detail="不支持的矢量格式")
 
-    # 生成shp文件路径
-    shp_dir = os.path.join(IMAGE_DIRECTORY, "temp_shp")
-    os.makedirs(shp_dir, exist_ok=True)
+    # 每个请求使用独立的临时目录，避免并发请求互相覆盖
+    shp_dir = tempfile.mkdtemp(prefix="temp_shp_", dir=IMAGE_DIRECTORY)
 
-    # 生成shp相关文件
+    # 生成矢量文件
     obj_manager = ImageManager()
-    obj_manager.readImg(os.path.join(IMAGE_DIRECTORY, filename))
-    obj_manager.tif2shp(shp_dir)  # 确保输出到临时目录
+    obj_manager.readImg(os.path.join(IMAGE_DIRECTORY, filename), lazy=True)
+    try:
+        obj_manager.tif2shp(shp_dir, dictFormats[strFormat])  # 确保输出到临时目录
+    finally:
+        obj_manager.close()
 
     # 创建ZIP文件
-    zip_path = os.path.join(IMAGE_DIRECTORY, f"{filename_base}_shp.zip")
-    shp_files = [f for f in os.listdir(shp_dir) if f.startswith(filename_base)]
-
+    zip_path = os.path.join(IMAGE_DIRECTORY, f"{filename_base}_{strFormat}.zip")
     with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for file in shp_files:
-            file_path = os.path.join(shp_dir, file)
-            zipf.write(file_path, arcname=file)
+        for file in os.listdir(shp_dir):
+            zipf.write(os.path.join(shp_dir, file), arcname=file)
 
     # 清理临时文件
-    for file in shp_files:
-        os.remove(os.path.join(shp_dir, file))
-    os.rmdir(shp_dir)
+    shutil.rmtree(shp_dir, ignore_errors=True)
     current_date = datetime.now().strftime("%Y年%m月%d日 %H时%M分%S秒") 
   # 生成日期字符串
      # 新增数据库日志记录
@@ -464,7 +588,7 @@ async def save_ShpFile(data: dict):
     # 返回ZIP文件
     return FileResponse(
         path=zip_path,
-        filename=f"{filename_base}_shp.zip",
+        filename=f"{filename_base}_{strFormat}.zip",
         media_type='application/zip'
     )
 
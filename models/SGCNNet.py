@@ -5,10 +5,8 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-import numpy as np
 BatchNorm2d = nn.BatchNorm2d
 BatchNorm1d = nn.BatchNorm1d
-device = torch.device("cuda:0")
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -57,11 +55,10 @@ class Sobel(nn.Module):
         kernel_x = [[-1.0,0.0,1.0],[-2.0,0.0,2.0],[-1.0,0.0,1.0]]
         kernel_y = [[-1.0,-2.0,-1.0],[0.0,0.0,0.0],[1.0,2.0,1.0]]
         kernel_x = torch.FloatTensor(kernel_x).expand(out_channel,in_channel,3,3)
-        kernel_x = kernel_x.type(torch.cuda.FloatTensor)
-        kernel_y = torch.cuda.FloatTensor(kernel_y).expand(out_channel,in_channel,3,3)
-        kernel_y = kernel_y.type(torch.cuda.FloatTensor)
-        self.weight_x = nn.Parameter(data=kernel_x, requires_grad=False).clone()
-        self.weight_y = nn.Parameter(data=kernel_y, requires_grad=False).clone()
+        kernel_y = torch.FloatTensor(kernel_y).expand(out_channel,in_channel,3,3)
+        # 固定的Sobel算子注册为不保存的buffer，随model.to()移动到任意设备，权重文件格式不变
+        self.register_buffer('weight_x', kernel_x.clone(), persistent=False)
+        self.register_buffer('weight_y', kernel_y.clone(), persistent=False)
         self.softmax = nn.Softmax()
     
     def forward(self,x):
@@ -90,20 +87,13 @@ class GCNSpatial(nn.Module):
     
     def normalize(self,A):
         b,c,im = A.size()
-        out = np.array([])
-        for i in range(b):
-            A1 = A[i].to(device="cpu")
-            I = torch.eye(c,im)
-            A1 = A1 + I
-            # degree matrix
-            d = A1.sum(1)
-            #D = D^-1/2
-            D = torch.diag(torch.pow(d , -0.5))   
-            new_A = D.mm(A1).mm(D).detach().numpy()
-            out = np.append(out,new_A)       
-        out = out.reshape(b,c,im)
-        normalize_A = torch.from_numpy(out)
-        normalize_A = normalize_A.type(torch.cuda.FloatTensor)
+        # 整批一起计算，没有Python循环和CPU中转，可被torch.onnx导出且批大小可变
+        I = torch.eye(c,im,device=A.device,dtype=A.dtype)
+        A1 = A + I
+        # degree matrix, d = D^-1/2的对角元素
+        d = torch.pow(A1.sum(2) , -0.5)
+        # D^-1/2 (A+I) D^-1/2的第(i,j)个元素为d_i * A1_ij * d_j，按行、列广播缩放，不构造对角阵做矩阵乘法
+        normalize_A = A1 * d.unsqueeze(2) * d.unsqueeze(1)
         return normalize_A
 
     def forward(self,x):
@@ -143,21 +133,13 @@ class GCNChannel(nn.Module):
 
     def normalize(self,A):
         b,c,im = A.size()
-        out = np.array([])
-        for i in range(b):
-            # A = A = I
-            A1 = A[i].to(device="cpu")
-            I = torch.eye(c,im)
-            A1 = A1 + I
-            # degree matrix
-            d = A1.sum(1)
-            # D = D^-1/2
-            D = torch.diag(torch.pow(d , -0.5))
-            new_A = D.mm(A1).mm(D).detach().numpy()
-            out = np.append(out,new_A)         
-        out = out.reshape(b,c,im)
-        normalize_A = torch.from_numpy(out)
-        normalize_A = normalize_A.type(torch.cuda.FloatTensor)
+        I = torch.eye(c,im,device=A.device,dtype=A.dtype)
+        # A = A + I
+        A1 = A + I
+        # degree matrix, d = D^-1/2的对角元素
+        d = torch.pow(A1.sum(2) , -0.5)
+        # D^-1/2 (A+I) D^-1/2，按行、列广播缩放
+        normalize_A = A1 * d.unsqueeze(2) * d.unsqueeze(1)
         return normalize_A
 
     def forward(self,x):
@@ -40,14 +40,25 @@ class DecoderBlock(nn.Module):
         return x
 
 
+# 非局部块的注意力实现：
+#   dense   一次构造完整的(HW x HW/4)相似度矩阵（原实现）
+#   sdpa    F.scaled_dot_product_attention，CPU/GPU上使用分块的融合内核，内存随HW线性增长
+#   chunked 按chunk_size个查询位置分块计算softmax，不依赖融合内核，内存同样随HW线性增长
+ATTENTION_MODES = ('dense', 'sdpa', 'chunked')
+
+
 class _NonLocalBlock2D_EGaussian(nn.Module):
-    def __init__(self, in_channels, inter_channels=None, dimension=3, sub_sample=True, bn_layer=True):
+    def __init__(self, in_channels, inter_channels=None, dimension=3, sub_sample=True, bn_layer=True,
+                 attention='sdpa', chunk_size=1024):
         super(_NonLocalBlock2D_EGaussian, self).__init__()
 
         assert dimension in (1, 2, 3)
+        assert attention in ATTENTION_MODES
 
         self.dimension = dimension
         self.sub_sample = sub_sample
+        self.attention = attention
+        self.chunk_size = chunk_size
 
         self.in_channels = in_channels
         self.inter_channels = inter_channels
@@ -95,10 +106,7 @@ class _NonLocalBlock2D_EGaussian(nn.Module):
         theta_x = self.theta(x).view(batch_size, self.inter_channels, -1)
         theta_x = theta_x.permute(0, 2, 1)
         phi_x = self.phi(x).view(batch_size, self.inter_channels, -1)
-        f = torch.matmul(theta_x, phi_x)
-        f_div_C = F.softmax(f, dim=-1)
-
-        y = torch.matmul(f_div_C, g_x)
+        y = self.attend(theta_x, phi_x, g_x)
         y = y.permute(0, 2, 1).contiguous()
         y = y.view(batch_size, self.inter_channels, *x.size()[2:])
         W_y = self.W(y)
@@ -106,21 +114,37 @@ class _NonLocalBlock2D_EGaussian(nn.Module):
 
         return z
 
+    def attend(self, theta_x, phi_x, g_x):
+        """softmax(theta_x @ phi_x) @ g_x，theta_x为(b, HW, C)，phi_x为(b, C, HW')，g_x为(b, HW', C)"""
+        if self.attention == 'sdpa':
+            # 原实现的相似度不除以sqrt(C)，因此scale取1；输入不连续时会退回到构造完整矩阵的实现
+            query, key, value = (t.unsqueeze(1).contiguous() for t in (theta_x, phi_x.transpose(1, 2), g_x))
+            return F.scaled_dot_product_attention(query, key, value, scale=1.0).squeeze(1)
+        if self.attention == 'chunked':
+            return torch.cat([torch.matmul(F.softmax(torch.matmul(theta_chunk, phi_x), dim=-1), g_x)
+                              for theta_chunk in theta_x.split(self.chunk_size, dim=1)], dim=1)
+        f = torch.matmul(theta_x, phi_x)
+        f_div_C = F.softmax(f, dim=-1)
+        return torch.matmul(f_div_C, g_x)
+
 
 class NONLocalBlock2D_EGaussian(_NonLocalBlock2D_EGaussian):
-    def __init__(self, in_channels, inter_channels=None, sub_sample=True, bn_layer=True):
+    def __init__(self, in_channels, inter_channels=None, sub_sample=True, bn_layer=True, attention='sdpa',
+                 chunk_size=1024):
         super(NONLocalBlock2D_EGaussian, self).__init__(in_channels,
                                                         inter_channels=inter_channels,
                                                         dimension=2, sub_sample=sub_sample,
-                                                        bn_layer=bn_layer)
+                                                        bn_layer=bn_layer, attention=attention,
+                                                        chunk_size=chunk_size)
 
 
 class NL34_LinkNet(nn.Module):
-    def __init__(self, num_classes=1, num_channels=3):
+    def __init__(self, num_classes=1, num_channels=3, pretrained=True, attention='sdpa', chunk_size=1024):
         super(NL34_LinkNet, self).__init__()
 
         filters = [256, 512, 1024, 2048]
-        resnet = models.resnet101(pretrained=True)
+        # pretrained=False时不下载ImageNet权重（加载已训练的权重或基准测试时使用）
+        resnet = models.resnet101(pretrained=pretrained)
         self.firstconv = resnet.conv1
         self.firstbn = resnet.bn1
         self.firstrelu = resnet.relu
@@ -128,9 +152,9 @@ class NL34_LinkNet(nn.Module):
 
         self.encoder1 = resnet.layer1
         self.encoder2 = resnet.layer2
-        self.nonlocal3 = NONLocalBlock2D_EGaussian(512)
+        self.nonlocal3 = NONLocalBlock2D_EGaussian(512, attention=attention, chunk_size=chunk_size)
         self.encoder3 = resnet.layer3
-        self.nonlocal4 = NONLocalBlock2D_EGaussian(1024)
+        self.nonlocal4 = NONLocalBlock2D_EGaussian(1024, attention=attention, chunk_size=chunk_size)
         self.encoder4 = resnet.layer4
 
         self.decoder4 = DecoderBlock(filters[3], filters[2])
@@ -144,6 +168,14 @@ class NL34_LinkNet(nn.Module):
         self.finalrelu2 = nonlinearity
         self.finalconv3 = nn.Conv2d(32, num_classes, 3, padding=1)
 
+    def set_attention(self, attention, chunk_size=None):
+        """切换非局部块的注意力实现（见ATTENTION_MODES），不影响权重"""
+        assert attention in ATTENTION_MODES
+        for block in (self.nonlocal3, self.nonlocal4):
+            block.attention = attention
+            if chunk_size is not None:
+                block.chunk_size = chunk_size
+
     def forward(self, x):
         # Encoder
         x = self.firstconv(x)
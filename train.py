@@ -2,10 +2,12 @@ import shutil
 import time
 import os
 import logging
+import multiprocessing
 from tqdm import tqdm
 from utils import dataset
+from utils.shard_dataset import ShardDataset
 from models import nllinknet, SGCNNet, unet
-from metrics import eval_metrics
+from metrics import ConfusionMatrix
 import numpy as np
 import torch
 import torch.nn as nn
@@ -45,8 +47,15 @@ def train(config):
 
         ]
     )
-    dst_train = dataset.Dataset(config['train_list'], transform=transform)
-    dataloader_train = DataLoader(dst_train, shuffle=True, batch_size=config['batch_size'])
+    # 样本在加载进程中解码并留在CPU上，训练循环中再异步复制到device
+    dictLoader = loaderOptions(config, device)
+    cache_bytes = int(config.get('cache_mb', 0) * 1024 ** 2)
+    if config.get('train_shards'):
+        # 预切片分片：加载进程只做内存映射切片，归一化在搬运到device后进行
+        dst_train = ShardDataset(config['train_shards'])
+    else:
+        dst_train = dataset.Dataset(config['train_list'], transform=transform, device='cpu', cache_bytes=cache_bytes)
+    dataloader_train = DataLoader(dst_train, shuffle=True, batch_size=config['batch_size'], **dictLoader)
 
     # validation data
     transform = transforms.Compose(
@@ -55,10 +64,15 @@ def train(config):
 
          ]
     )
-    dst_valid = dataset.Dataset(config['test_list'], transform=transform)
-    dataloader_valid = DataLoader(dst_valid, shuffle=False, batch_size=config['batch_size'])
+    if config.get('test_shards'):
+        dst_valid = ShardDataset(config['test_shards'])
+    else:
+        dst_valid = dataset.Dataset(config['test_list'], transform=transform, device='cpu', cache_bytes=cache_bytes)
+    dataloader_valid = DataLoader(dst_valid, shuffle=False, batch_size=config['batch_size'], **dictLoader)
 
     cur_acc = []
+    # 进度条上的OA、mIoU每隔log_interval批刷新一次
+    log_interval = config.get('log_interval', 20)
     # optimizer
     optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], betas=[config['momentum'], 0.999],
                                  weight_decay=config['weight_decay'])
@@ -84,21 +98,17 @@ def train(config):
         # lr
         model.train()
         loss_sum = 0.0
-        correct_sum = 0.0
-        labeled_sum = 0.0
-        inter_sum = 0.0
-        unoin_sum = 0.0
         pixelAcc = 0.0
-        IoU = 0.0
         tbar = tqdm(dataloader_train, ncols=120)
 
-        # confuse_matrix
-        conf_matrix_train = np.zeros((config['num_classes'], config['num_classes']))
+        # confuse_matrix，在训练设备上累加
+        conf_matrix_train = ConfusionMatrix(config['num_classes'], device)
+        IoU = np.zeros(config['num_classes'])
 
         for batch_idx, (data, target) in enumerate(tbar):
             tic = time.time()
 
-            # data, target = data.to(device), target.to(device)
+            data, target = toDevice(data, target, device, transform.transforms[-1])
             optimizer.zero_grad()
             output = model(data)
             loss = criterion(output, target)
@@ -106,75 +116,64 @@ def train(config):
             loss.backward()
             optimizer.step()
 
-            correct, labeled, inter, unoin, conf_matrix_train = eval_metrics(output, target, config['num_classes'],
-                                                                             conf_matrix_train)
-            correct_sum += correct
-            labeled_sum += labeled
-            inter_sum += inter
-            unoin_sum += unoin
-            pixelAcc = 1.0 * correct_sum / (np.spacing(1) + labeled_sum)
-            IoU = 1.0 * inter_sum / (np.spacing(1) + unoin_sum)
+            conf_matrix_train.update(output, target)
+            # 每批只在设备上累加混淆矩阵，进度条的指标每log_interval批才复制到CPU计算一次
+            if (batch_idx + 1) % log_interval == 0 or batch_idx + 1 == len(dataloader_train):
+                dictMetrics = conf_matrix_train.compute()
+                pixelAcc = dictMetrics['OA']
+                IoU = dictMetrics['IoU']
+                cur_acc.append(pixelAcc)
             tbar.set_description('TRAIN ({}) | Loss: {:.5f} | OA {:.5f} mIoU {:.5f} | bt {:.2f} et {:.2f}|\n'.format(
                 initepoch, loss_sum / (batch_idx + 1),
                 pixelAcc, IoU.mean(),
                            time.time() - tic, time.time() - epoch_start))
-            cur_acc.append(pixelAcc)
-            logger.info('TRAIN ({}) | Loss: {:.5f} | OA {:.5f} IOU {}  mIoU {:.5f} '.format(initepoch, loss_sum / (batch_idx + 1),pixelAcc, toString(IoU), IoU.mean()))
+        if len(dataloader_train):
+            logger.info('TRAIN ({}) | Loss: {:.5f} | OA {:.5f} IOU {}  mIoU {:.5f} '.format(initepoch, loss_sum / len(dataloader_train),pixelAcc, toString(IoU), IoU.mean()))
             logger.handlers[0].flush()
             # val
         test_start = time.time()
 
         model.eval()
         loss_sum = 0.0
-        correct_sum = 0.0
-        labeled_sum = 0.0
-        inter_sum = 0.0
-        unoin_sum = 0.0
         pixelAcc = 0.0
-        mIoU = 0.0
 
         tbar = tqdm(dataloader_valid, ncols=120)
-        class_precision = np.zeros(config['num_classes'])
-        class_recall = np.zeros(config['num_classes'])
-        class_f1 = np.zeros(config['num_classes'])
 
         with torch.no_grad():
             # confuse_matrix
-            conf_matrix_val = np.zeros((config['num_classes'], config['num_classes']))
+            conf_matrix_val = ConfusionMatrix(config['num_classes'], device)
+            mIoU = np.zeros(config['num_classes'])
             for batch_idx, (data, target) in enumerate(tbar):
                 tic = time.time()
 
+                data, target = toDevice(data, target, device, transform.transforms[-1])
                 output = model(data)
                 loss = criterion(output, target)
                 loss_sum += loss.item()
 
-                correct, labeled, inter, unoin, conf_matrix_val = eval_metrics(output, target, config['num_classes'],
-                                                                               conf_matrix_val)
-                correct_sum += correct
-                labeled_sum += labeled
-                inter_sum += inter
-                unoin_sum += unoin
-                pixelAcc = 1.0 * correct_sum / (np.spacing(1) + labeled_sum)
-                mIoU = 1.0 * inter_sum / (np.spacing(1) + unoin_sum)
-
-                for i in range(config['num_classes']):
-                    # precision of each class
-                    class_precision[i] = 1.0 * conf_matrix_val[i, i] / conf_matrix_val[:, i].sum()
-                    # recall of each class
-                    class_recall[i] = 1.0 * conf_matrix_val[i, i] / conf_matrix_val[i].sum()
-                    # f1 of each class
-                    class_f1[i] = (2.0 * class_precision[i] * class_recall[i]) / (class_precision[i] + class_recall[i])
+                conf_matrix_val.update(output, target)
+                if (batch_idx + 1) % log_interval == 0:
+                    dictMetrics = conf_matrix_val.compute()
+                    pixelAcc, mIoU = dictMetrics['OA'], dictMetrics['IoU']
 
                 tbar.set_description('VAL ({}) | Loss: {:.5f} | Acc {:.5f} mIoU {:.5f} | bt {:.2f} et {:.2f}|\n'.format(
                     initepoch, loss_sum / (batch_idx + 1),
                     pixelAcc, mIoU.mean(),
                                time.time() - tic, time.time() - test_start))
-                logger.info(
-                    'VAL ({}) | Loss: {:.5f} | OA {:.5f} |IOU {} |mIoU {:.5f} |class_precision {}| class_recall {} | class_f1 {}|'.format(
-                        initepoch, loss_sum / (batch_idx + 1),
-                        pixelAcc, toString(mIoU), mIoU.mean(), toString(class_precision), toString(class_recall),
-                        toString(class_f1)))
-                logger.handlers[0].flush()
+
+            # OA、IoU、各类精确率、召回率和F1在每轮结束时由混淆矩阵一次得到
+            dictMetrics = conf_matrix_val.compute()
+            pixelAcc = dictMetrics['OA']
+            mIoU = dictMetrics['IoU']
+            class_precision = dictMetrics['precision']
+            class_recall = dictMetrics['recall']
+            class_f1 = dictMetrics['F1']
+            logger.info(
+                'VAL ({}) | Loss: {:.5f} | OA {:.5f} |IOU {} |mIoU {:.5f} |class_precision {}| class_recall {} | class_f1 {}|'.format(
+                    initepoch, loss_sum / max(1, len(dataloader_valid)),
+                    pixelAcc, toString(mIoU), mIoU.mean(), toString(class_precision), toString(class_recall),
+                    toString(class_f1)))
+            logger.handlers[0].flush()
 
             if os.path.exists(config['save_model']['save_path']) is False:
                 os.mkdir(config['save_model']['save_path'])
@@ -190,7 +189,7 @@ def train(config):
                 val_max_pixACC = pixelAcc
                 best_epoch = np.zeros(2)
                 best_epoch[0] = initepoch
-                best_epoch[1] = conf_matrix_val.sum()
+                best_epoch[1] = dictMetrics['labeled']
 
                 torch.save(model.state_dict(), os.path.join(config['save_model']['save_path'], selected + '_best.pth'))
 
@@ -211,6 +210,26 @@ def train(config):
         initepoch += 1
 
 
+def toDevice(data, target, device, normalize):
+    """异步复制到device；ShardDataset给出的uint8批次在device上完成ToTensor的缩放和归一化"""
+    data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+    if data.dtype == torch.uint8:
+        data = normalize(data.float().div_(255))
+    return data, target.long()
+
+
+def loaderOptions(config, device):
+    """DataLoader的加载进程数、锁页内存和预取设置，config中的num_workers、prefetch_factor可覆盖默认值
+    spawn方式（Windows）启动加载进程会重新导入主模块，因此只在支持fork的系统上默认开启多进程加载"""
+    intDefaultWorkers = min(4, os.cpu_count() or 1) if multiprocessing.get_start_method() == 'fork' else 0
+    intWorkers = config.get('num_workers', intDefaultWorkers)
+    dictLoader = {"num_workers": intWorkers, "pin_memory": device.type == 'cuda'}
+    if intWorkers > 0:
+        # 加载进程在各轮之间保留，不再每轮重新启动
+        dictLoader.update(persistent_workers=True, prefetch_factor=config.get('prefetch_factor', 2))
+    return dictLoader
+
+
 def toString(IOU):
     result = '{'
     for i, num in enumerate(IOU):
@@ -0,0 +1,286 @@
+"""分块预测流程的基准测试：生成指定大小和波段数的合成影像，用随机初始化的权重跑完整的
+裁剪 → 归一化 → 推理 → 着色 → 拼接 → 保存流程，输出每个模型的切片吞吐量、各阶段耗时、峰值内存和结果文件大小
+
+每个模型在独立的子进程中运行，峰值内存互不影响；结果写成JSON，可以对比两次提交的数值：
+    python benchmark.py --models SGCNNet LinkNet UNet --size 4096 --output before.json
+    python benchmark.py --models SGCNNet LinkNet UNet --size 4096 --output after.json --compare before.json
+
+各阶段耗时是该步骤函数内累计的时间。切片读取和归一化在预取线程中与推理并行执行，
+因此各阶段之和可能大于总耗时；read、predict、save三个流程阶段的墙钟时间见phases。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import torch
+from osgeo import gdal, osr
+
+import predictor
+from utils.geo_utils import ImageManager, StitchAccumulator, _gdalDataType, _writeInterleaved
+
+try:
+    import resource
+except ImportError:  # Windows上没有resource模块，不统计峰值内存
+    resource = None
+
+MODEL_NAMES = ['SGCNNet', 'LinkNet', 'UNet']
+STAGE_NAMES = ['read', 'crop', 'normalize', 'infer', 'colourize', 'stitch', 'save']
+
+
+def makeSyntheticRaster(strPath, intWidth, intHeight, intBands=3, strDtype='uint8', intSeed=0, intStripRows=1024):
+    """生成平滑纹理加噪声的合成影像，.tif按DEFLATE压缩的瓦片化GeoTIFF（WGS84地理坐标）写出，其余格式用OpenCV写出"""
+    rng = np.random.default_rng(intSeed)
+    npDtype = np.dtype(strDtype)
+    # uint16按常见的地表反射率量级生成，用于测试归一化
+    intMax = 255 if npDtype == np.uint8 else 4000
+
+    def makeStrip(intRows):
+        npLow = rng.random((intRows // 32 + 2, intWidth // 32 + 2, intBands), dtype=np.float32)
+        npStrip = cv2.resize(npLow, (intWidth, intRows), interpolation=cv2.INTER_CUBIC).reshape(
+            intRows, intWidth, intBands)
+        npStrip += rng.normal(0, 0.05, npStrip.shape).astype(np.float32)
+        return (np.clip(npStrip, 0, 1) * intMax).astype(npDtype)
+
+    if not strPath.lower().endswith(('.tif', '.tiff')):
+        cv2.imwrite(strPath, makeStrip(intHeight))
+        return strPath
+
+    driver = gdal.GetDriverByName('GTiff')
+    outDataset = driver.Create(strPath, intWidth, intHeight, intBands, _gdalDataType(npDtype),
+                               options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    outDataset.SetGeoTransform((116.0, 1e-5, 0, 40.0, 0, -1e-5))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    outDataset.SetProjection(srs.ExportToWkt())
+    for intYOff in range(0, intHeight, intStripRows):
+        _writeInterleaved(outDataset, makeStrip(min(intStripRows, intHeight - intYOff)), 0, intYOff)
+    outDataset.FlushCache()
+    outDataset = None
+    return strPath
+
+
+@contextmanager
+def stageTimers():
+    """在上下文中给流程的各个步骤计时，返回 阶段 -> 累计秒数 的字典"""
+    dictSeconds = defaultdict(float)
+    lock = threading.Lock()
+
+    def timed(func, strStage):
+        def wrapper(*args, **kwargs):
+            dblStart = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with lock:
+                    dictSeconds[strStage] += time.perf_counter() - dblStart
+        return wrapper
+
+    def timedIter(func, strStage):
+        # 生成器的耗时在每次取下一个元素时累计
+        def wrapper(*args, **kwargs):
+            iterItems = iter(func(*args, **kwargs))
+            while True:
+                dblStart = time.perf_counter()
+                try:
+                    item = next(iterItems)
+                except StopIteration:
+                    return
+                finally:
+                    with lock:
+                        dictSeconds[strStage] += time.perf_counter() - dblStart
+                yield item
+        return wrapper
+
+    listPatches = [(ImageManager, 'iterCrops', timedIter, 'crop'),
+                   (predictor, 'loadCropBatch', timed, 'normalize'),
+                   (predictor, 'forwardBatch', timed, 'infer'),
+                   (predictor, 'labelToVisual', timed, 'colourize'),
+                   (StitchAccumulator, 'addTile', timed, 'stitch'),
+                   (StitchAccumulator, 'close', timed, 'stitch')]
+    listOriginals = [(owner, strName, getattr(owner, strName)) for owner, strName, _, _ in listPatches]
+    for owner, strName, funcWrap, strStage in listPatches:
+        setattr(owner, strName, funcWrap(getattr(owner, strName), strStage))
+    try:
+        yield dictSeconds
+    finally:
+        for owner, strName, func in listOriginals:
+            setattr(owner, strName, func)
+
+
+def peakRssBytes():
+    if resource is None:
+        return None
+    intPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return intPeak if sys.platform == 'darwin' else intPeak * 1024
+
+
+def runCase(dictCase):
+    """在子进程中对一个模型跑intRepeat次完整流程，返回耗时中位数那一次的结果"""
+    torch.manual_seed(dictCase['seed'])
+    predictor.configureRuntime('cpu', dictCase['threads'], dictCase['interop_threads'], dictCase['precision'])
+    strWorkDir = tempfile.mkdtemp(prefix='bench_', dir=dictCase['work_dir'])
+    os.chdir(strWorkDir)
+    strOutDir = os.path.join(strWorkDir, 'out')
+    os.makedirs(strOutDir)
+
+    # 随机权重按用户权重的方式加载，与线上走同一条路径
+    strWeights = dictCase['model'] + '_bench.pth'
+    torch.save(predictor.buildModel(dictCase['model'], 2, isPretrained=False).state_dict(), strWeights)
+    if dictCase['backend'] == 'onnx':
+        from export_onnx import exportOnnx
+        exportOnnx(dictCase['model'], strWeights, None, 2, dictCase['tile_size'])
+
+    df = {"FileName": dictCase['raster'], "ModelName": dictCase['model'], "Extraction": "道路",
+          "Weights": strWeights, "BatchSize": dictCase['batch_size'], "Backend": dictCase['backend'],
+          "Stream": dictCase['stream'], "TileSize": dictCase['tile_size'], "TileStep": dictCase['tile_step'],
+          "Attention": dictCase['attention']}
+    dblStart = time.perf_counter()
+    predictor.load_model(predictor.buildPredictConfig(df, strWorkDir))
+    dblLoadSeconds = time.perf_counter() - dblStart
+
+    listRuns = []
+    for _ in range(dictCase['repeat']):
+        dictPhases = {}
+        dictTiles = {"total": 0}
+        listMarks = []  # (阶段, 开始时间)
+
+        def funcProgress(strStage, intDone, intTotal):
+            if not listMarks or listMarks[-1][0] != strStage:
+                listMarks.append((strStage, time.perf_counter()))
+            if strStage == 'predict':
+                dictTiles["total"] = intTotal
+
+        with stageTimers() as dictStages:
+            dblStart = time.perf_counter()
+            dictResult = predictor.predictImage(df, strWorkDir, strOutDir, funcProgress)
+            dblEnd = time.perf_counter()
+        for (strStage, dblBegin), (_, dblNext) in zip(listMarks, listMarks[1:] + [(None, dblEnd)]):
+            dictPhases[strStage] = dblNext - dblBegin
+        dictStages.update(read=dictPhases.get('read', 0.0), save=dictPhases.get('save', 0.0))
+        listRuns.append({"wall_seconds": dblEnd - dblStart, "tiles": dictTiles["total"], "phases": dictPhases,
+                         "stages": {strStage: dictStages[strStage] for strStage in STAGE_NAMES},
+                         "output_bytes": {strKey: os.path.getsize(os.path.join(strOutDir, strName))
+                                          for strKey, strName in dictResult.items()}})
+
+    dictRun = sorted(listRuns, key=lambda d: d['wall_seconds'])[len(listRuns) // 2]
+    dblPredict = dictRun['phases'].get('predict') or dictRun['wall_seconds']
+    dictRun.update(model=dictCase['model'], model_load_seconds=dblLoadSeconds,
+                   tiles_per_second=dictRun['tiles'] / dblPredict,
+                   all_wall_seconds=[d['wall_seconds'] for d in listRuns], peak_rss_bytes=peakRssBytes())
+    return dictRun
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=predictor.MODEL_TRAINER_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmark(listModels, intWidth, intHeight, intBands=3, strDtype='uint8', strFormat='tif', intRepeat=1,
+                 intThreads=None, intInteropThreads=None, strPrecision='fp32', strBackend='torch', isStream=True,
+                 intBatchSize=None, intTileSize=512, intTileStep=256, intSeed=0, strAttention='sdpa'):
+    """生成合成影像并依次测试各模型，返回报告字典"""
+    with tempfile.TemporaryDirectory(prefix='lcisp_bench_') as strWorkDir:
+        strRaster = os.path.join(strWorkDir, 'synthetic.' + strFormat)
+        dblStart = time.perf_counter()
+        makeSyntheticRaster(strRaster, intWidth, intHeight, intBands, strDtype, intSeed)
+        print("合成影像{}x{}x{}({})用时{:.2f}秒".format(intWidth, intHeight, intBands, strDtype,
+                                                   time.perf_counter() - dblStart))
+
+        dictReport = {
+            "meta": {"commit": gitCommit(), "python": platform.python_version(), "torch": torch.__version__,
+                     "platform": platform.platform(), "cpu_count": os.cpu_count()},
+            "params": {"width": intWidth, "height": intHeight, "bands": intBands, "dtype": strDtype,
+                       "format": strFormat, "repeat": intRepeat, "threads": intThreads or torch.get_num_threads(),
+                       "interop_threads": intInteropThreads, "precision": strPrecision, "backend": strBackend,
+                       "stream": isStream, "batch_size": intBatchSize, "tile_size": intTileSize,
+                       "tile_step": intTileStep, "seed": intSeed, "attention": strAttention},
+            "results": [],
+        }
+        # 每个模型用新的子进程，峰值内存和已加载的模型互不影响
+        context = multiprocessing.get_context('spawn')
+        for strModel in listModels:
+            dictCase = dict(dictReport["params"], model=strModel, raster=strRaster, work_dir=strWorkDir,
+                            threads=intThreads, interop_threads=intInteropThreads)
+            with context.Pool(1) as pool:
+                try:
+                    dictResult = pool.apply(runCase, (dictCase,))
+                except Exception as e:
+                    print("{}基准测试失败: {}".format(strModel, e))
+                    dictResult = {"model": strModel, "error": str(e)}
+            dictReport["results"].append(dictResult)
+    return dictReport
+
+
+def printReport(dictReport, dictBaseline=None):
+    """打印各模型的结果，给出基线报告时同时打印相对变化"""
+    dictOld = {d['model']: d for d in (dictBaseline or {}).get('results', []) if 'error' not in d}
+    if dictBaseline and dictBaseline.get('params') != dictReport['params']:
+        print("注意：基线报告的测试参数不同，对比结果仅供参考")
+    for dictResult in dictReport['results']:
+        if 'error' in dictResult:
+            print("{}: 失败 {}".format(dictResult['model'], dictResult['error']))
+            continue
+        strStages = ' '.join("{} {:.2f}s".format(k, v) for k, v in dictResult['stages'].items())
+        strRss = "{:.0f} MB".format(dictResult['peak_rss_bytes'] / 1024 ** 2) if dictResult['peak_rss_bytes'] else "-"
+        print("{}: {}个切片 {:.2f}切片/秒 总计{:.2f}s | {} | 峰值内存{} | 结果{:.1f} MB".format(
+            dictResult['model'], dictResult['tiles'], dictResult['tiles_per_second'], dictResult['wall_seconds'],
+            strStages, strRss, sum(dictResult['output_bytes'].values()) / 1024 ** 2))
+        dictBase = dictOld.get(dictResult['model'])
+        if dictBase:
+            print("    对比基线({}): 吞吐量{:+.1%} 总耗时{:+.1%}".format(
+                dictBaseline['meta'].get('commit'),
+                dictResult['tiles_per_second'] / dictBase['tiles_per_second'] - 1,
+                dictResult['wall_seconds'] / dictBase['wall_seconds'] - 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="分块预测流程基准测试（CPU，随机权重）")
+    parser.add_argument('--models', nargs='+', default=MODEL_NAMES, choices=MODEL_NAMES)
+    parser.add_argument('--size', type=int, default=2048, help="合成影像边长，可用--width/--height分别指定")
+    parser.add_argument('--width', type=int, default=None)
+    parser.add_argument('--height', type=int, default=None)
+    parser.add_argument('--bands', type=int, default=3, help="分割模型只接受3波段输入")
+    parser.add_argument('--dtype', default='uint8', choices=['uint8', 'uint16'])
+    parser.add_argument('--format', default='tif', choices=['tif', 'png'])
+    parser.add_argument('--repeat', type=int, default=1, help="每个模型重复次数，报告耗时中位数那一次")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--interop-threads', type=int, default=None)
+    parser.add_argument('--precision', default='fp32', choices=['auto', 'fp32', 'bf16'])
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'])
+    parser.add_argument('--disk', action='store_true', help="使用经Crops目录中转的磁盘模式")
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--tile-step', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--attention', default='sdpa', choices=['dense', 'sdpa', 'chunked'], help="LinkNet非局部块的实现")
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help="作为基线对比的JSON报告")
+    args = parser.parse_args()
+
+    dictReport = runBenchmark(args.models, args.width or args.size, args.height or args.size, args.bands, args.dtype,
+                              args.format, args.repeat, args.threads, args.interop_threads, args.precision,
+                              args.backend, not args.disk, args.batch_size, args.tile_size, args.tile_step, args.seed,
+                              args.attention)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(dictReport, f, ensure_ascii=False, indent=2)
+    dictBaseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            dictBaseline = json.load(f)
+    printReport(dictReport, dictBaseline)
+    print("报告已保存到{}".format(args.output))
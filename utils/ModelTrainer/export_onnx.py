@@ -0,0 +1,74 @@
+"""把分割模型的.pth权重导出为ONNX，供预测时的onnx后端（ONNX Runtime）使用
+
+导出的图批大小和宽高都是动态的，输入名为input(N, 3, H, W)，输出名为logits(N, 类别数, H, W)。
+导出后用ONNX Runtime与PyTorch分别计算同一批随机输入，比较logits和类别图是否一致。
+
+用法：
+    python export_onnx.py --model SGCNNet --weights defaultModelWeights/SGCNNet_road.pth
+结果默认与权重同名（扩展名为.onnx），load_model在Backend为onnx时按这个名字查找。
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from predictor import buildModel
+
+
+def exportOnnx(strModelName, strWeights, strOutPath=None, num_classes=2, intSize=512, intOpset=17):
+    """导出ONNX模型并返回输出路径，strOutPath为空时与权重同名"""
+    strOutPath = strOutPath or os.path.splitext(strWeights)[0] + '.onnx'
+    model = buildModel(strModelName, num_classes, isPretrained=False)
+    model.load_state_dict(torch.load(strWeights, map_location='cpu'), False)
+    model.eval()
+
+    dictDynamic = {0: 'batch', 2: 'height', 3: 'width'}
+    with torch.inference_mode():
+        torch.onnx.export(model, (torch.rand(1, 3, intSize, intSize),), strOutPath, input_names=['input'],
+                          output_names=['logits'], dynamic_axes={'input': dictDynamic, 'logits': dictDynamic},
+                          opset_version=intOpset, do_constant_folding=True, dynamo=False)
+    print("导出{}到{}".format(strModelName, strOutPath))
+    return strOutPath
+
+
+def verifyOnnx(strModelName, strWeights, strOnnxPath, num_classes=2, listShapes=((2, 512, 512), (1, 256, 384)),
+               dblTolerance=1e-3):
+    """用不同的批大小和宽高比较ONNX Runtime与PyTorch的logits，全部一致时返回True"""
+    import onnxruntime as ort
+
+    model = buildModel(strModelName, num_classes, isPretrained=False)
+    model.load_state_dict(torch.load(strWeights, map_location='cpu'), False)
+    model.eval()
+    session = ort.InferenceSession(strOnnxPath, providers=['CPUExecutionProvider'])
+
+    isPassed = True
+    for intBatch, intHeight, intWidth in listShapes:
+        images = torch.rand(intBatch, 3, intHeight, intWidth)
+        with torch.inference_mode():
+            npExpected = model(images).numpy()
+        npActual = session.run(None, {'input': images.numpy()})[0]
+        dblDiff = float(np.abs(npActual - npExpected).max())
+        dblAgree = float((npActual.argmax(1) == npExpected.argmax(1)).mean())
+        # 误差按logits的量级放缩
+        isClose = dblDiff <= dblTolerance * max(1.0, float(np.abs(npExpected).max()))
+        print("输入{}：logits最大误差{:.2e}，类别一致率{:.4%}，{}".format(
+            (intBatch, 3, intHeight, intWidth), dblDiff, dblAgree, "通过" if isClose else "不通过"))
+        isPassed = isPassed and isClose
+    return isPassed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="导出分割模型为ONNX并校验")
+    parser.add_argument('--model', required=True, choices=['SGCNNet', 'LinkNet', 'UNet'])
+    parser.add_argument('--weights', required=True, help=".pth权重文件")
+    parser.add_argument('--output', default=None, help="输出的.onnx文件，默认与权重同名")
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--size', type=int, default=512, help="导出时示例输入的宽高")
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--skip-verify', action='store_true')
+    args = parser.parse_args()
+
+    strOnnxPath = exportOnnx(args.model, args.weights, args.output, args.num_classes, args.size, args.opset)
+    if not args.skip_verify and not verifyOnnx(args.model, args.weights, strOnnxPath, args.num_classes):
+        raise SystemExit("ONNX模型与PyTorch结果不一致")
@@ -1,34 +1,64 @@
 import torch
 import numpy as np
 
-def eval_metrics(output, target, num_classes,conf_matrix):
-    _, predict = output.max(1)
 
-    c_predict=predict.cpu().numpy().flatten()
-    c_target=target.cpu().numpy().flatten()
-    for i in range(len(c_predict)):
-        conf_matrix[c_predict[i],c_target[i]] += 1
+class ConfusionMatrix:
+    """混淆矩阵累加器，matrix[真实类别, 预测类别]在输出所在的设备上用bincount统计，
+    OA、各类IoU、精确率、召回率和F1都由compute()从矩阵一次性得到。真实类别不在[0, num_classes)内的像素不参与统计"""
+
+    def __init__(self, num_classes, device=None):
+        self.num_classes = num_classes
+        self.matrix = torch.zeros((num_classes, num_classes), dtype=torch.int64, device=device)
 
-    predict = predict.long() + 1
-    target = target.long() + 1
+    def reset(self):
+        self.matrix.zero_()
 
-    pixel_labeled = (target > 0).sum()
-    pixel_correct = ((predict == target)*(target > 0)).sum()
+    @torch.no_grad()
+    def update(self, output, target):
+        """output为(N, C, H, W)的logits或(N, H, W)的类别图，target为(N, H, W)的真实类别"""
+        # CPU上max沿通道维度比argmax快一个数量级
+        predict = output.max(1)[1] if output.dim() == target.dim() + 1 else output
+        if self.matrix.device != target.device:
+            self.matrix = self.matrix.to(target.device)
+        predict = predict.to(target.device).long().flatten()
+        target = target.long().flatten()
+        # 无效像素计入多出的一格后丢弃，避免布尔索引的复制
+        cells = self.num_classes ** 2
+        valid = (target >= 0) & (target < self.num_classes)
+        index = torch.where(valid, target * self.num_classes + predict, cells)
+        self.matrix += torch.bincount(index, minlength=cells + 1)[:cells].view(self.num_classes, -1)
+        return self
 
-    predict = predict * (target > 0).long()
-    intersection = predict * (predict == target).long()
+    def compute(self):
+        """返回各项指标（numpy），只在这里把矩阵复制到CPU一次"""
+        matrix = self.matrix.cpu().numpy().astype(np.float64)
+        inter = np.diag(matrix)
+        area_lab = matrix.sum(1)
+        area_pred = matrix.sum(0)
+        union = area_lab + area_pred - inter
+        correct, labeled = inter.sum(), matrix.sum()
+        iou = inter / (np.spacing(1) + union)
+        precision = inter / (np.spacing(1) + area_pred)
+        recall = inter / (np.spacing(1) + area_lab)
+        return {
+            "correct": correct, "labeled": labeled, "inter": inter, "union": union,
+            "OA": correct / (np.spacing(1) + labeled),
+            "IoU": iou, "mIoU": iou.mean(),
+            "precision": precision, "recall": recall,
+            "F1": 2.0 * precision * recall / (np.spacing(1) + precision + recall),
+        }
 
-    area_inter = torch.histc(intersection.float(), num_classes, 1, num_classes)
-    area_pred = torch.histc(predict.float(), num_classes, 1, num_classes)
-    area_lab = torch.histc(target.float(), num_classes, 1, num_classes)
-    area_union = area_pred + area_lab - area_inter
 
+def eval_metrics(output, target, num_classes,conf_matrix):
+    # 旧接口：conf_matrix为numpy数组，按[预测类别, 真实类别]累加；返回本批的正确数、标注数、各类交集和并集
+    matrix = ConfusionMatrix(num_classes, target.device).update(output, target).matrix.cpu().numpy()
+    conf_matrix += matrix.T
 
-    correct = np.round(pixel_correct.cpu().numpy(), 5)
-    labeld = np.round(pixel_labeled.cpu().numpy(), 5)
-    inter = np.round(area_inter.cpu().numpy(), 5)
-    union = np.round(area_union.cpu().numpy(), 5)
+    inter = np.diag(matrix).astype(np.float64)
+    union = matrix.sum(0) + matrix.sum(1) - inter
+    correct = inter.sum()
+    labeld = matrix.sum().astype(np.float64)
 
     #pixacc = 1.0 * correct / (np.spacing(1) + labeld)
     #mIoU = (1.0 * inter / (np.spacing(1) + union)).mean()
-    return correct, labeld, inter, union,conf_matrix
\ No newline at end of file
+    return correct, labeld, inter, union,conf_matrix
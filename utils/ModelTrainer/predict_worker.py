@@ -0,0 +1,53 @@
+"""常驻预测进程：模型加载一次后反复使用，由主服务的InferenceService通过标准输入输出通信
+
+协议为每行一个JSON：
+    请求 {"id": ..., "config": 前端预测参数, "workDir": 工作目录, "weightsDir": 用户权重目录, "assetsDir": 结果目录}
+    进度 {"id": ..., "progress": {"stage": 阶段, "done": 已完成数, "total": 总数}}，任务完成前可有任意多条
+    响应 {"id": ..., "ok": true, "result": {"Mixture": ..., "Origin": ...}} 或 {"id": ..., "ok": false, "error": ...}
+"""
+import json
+import os
+import sys
+import traceback
+
+# 标准输出只用于协议，预测过程中的打印信息全部转到标准错误
+protocolOut = sys.stdout
+sys.stdout = sys.stderr
+
+import predictor  # noqa: E402
+
+
+def sendMessage(dictMessage):
+    protocolOut.write(json.dumps(dictMessage, ensure_ascii=False) + '\n')
+    protocolOut.flush()
+
+
+def main():
+    # 推理设备和线程数由InferenceService通过环境变量传入
+    predictor.configureRuntime(os.environ.get('PREDICT_DEVICE') or None,
+                               int(os.environ.get('PREDICT_THREADS') or 0) or None,
+                               int(os.environ.get('PREDICT_INTEROP_THREADS') or 0) or None,
+                               os.environ.get('PREDICT_PRECISION') or 'auto',
+                               intModelCacheSize=int(os.environ.get('PREDICT_MODEL_CACHE') or 0) or None)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            # 每个任务在独立的工作目录中运行，裁剪和中间结果互不干扰
+            os.chdir(job['workDir'])
+            result = predictor.predictImage(
+                job['config'], job['weightsDir'], job['assetsDir'],
+                lambda strStage, intDone, intTotal: sendMessage(
+                    {"id": job['id'], "progress": {"stage": strStage, "done": intDone, "total": intTotal}}))
+            response = {"id": job['id'], "ok": True, "result": result}
+        except Exception as e:
+            traceback.print_exc()
+            response = {"id": job['id'], "ok": False, "error": str(e)}
+        finally:
+            os.chdir(predictor.MODEL_TRAINER_DIR)
+        sendMessage(response)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,363 @@
+import copy
 import json
 import os
 import shutil
 from pathlib import Path
-from shutil import copy2
 
 import cv2
-import nest_asyncio
 import numpy as np
 import torch
+import torch.nn as nn
 from PIL import Image
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision import transforms
 from models import SGCNNet
 from models import UNet
 from models import NlLinkNet
-import pandas as pd
-from utils import geo_utils
-from utils.geo_utils import ImageManager
-import asyncio
-import aiofiles
-nest_asyncio.apply()
-dataset_Rootdir = 'Crops'
-
-
-async def predict_single_image(config, image_name, num_classes):
-    transform = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.2304, 0.3295, 0.4405], std=[0.1389, 0.1316, 0.1278])
-        ]
-    )
-
-    root_path = dataset_Rootdir
-    image_path = os.path.join(root_path, image_name)
-
-    image = Image.open(image_path)
-    image = transform(image).float().cuda()
-    # batch_size=1
-    image = image.unsqueeze(0)
+from utils.geo_utils import ImageManager, ProcessedImageData, StitchAccumulator, TileGrid
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+MODEL_TRAINER_DIR = os.path.dirname(os.path.abspath(__file__))
 
-    model = load_model(config)
-    output = model(image)
-    _, pred = output.max(1)
-    pred = pred.view(config['img_width'], config['img_height'])
-    mask_im = pred.cpu().numpy().astype(np.uint8)
+# 常驻进程中复用已加载的模型，键为(模型结构, 类别数, 权重文件哈希, 后端, 注意力实现)，
+# 按最近使用排序，超过_dictRuntime['model_cache_size']个时淘汰最久未使用的模型
+_dictModelCache = OrderedDict()
+_dictWeightsHash = {}  # (权重路径, 修改时间, 大小) -> 哈希，避免重复读取权重文件
 
-    pre_base_path = config['pre_dir']
-    pre_mask_path = os.path.join(pre_base_path, 'mask')
-    pre_vis_path = os.path.join(pre_base_path, 'vis')
 
+transform = transforms.Compose(
+    [
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.2304, 0.3295, 0.4405], std=[0.1389, 0.1316, 0.1278])
+    ]
+)
+
+
+# 推理运行时设置，由configureRuntime修改
+_dictRuntime = {"device": None, "channels_last": False, "bf16": False, "model_cache_size": 2}
+
+
+def _cpuSupportsBf16():
+    # AVX512-BF16或AMX指令集上bfloat16卷积比float32快，其余CPU上反而更慢
+    return any(getattr(torch.cpu, strName, lambda: False)()
+               for strName in ('_is_avx512_bf16_supported', '_is_amx_tile_supported'))
+
+
+def configureRuntime(strDevice=None, intThreads=None, intInteropThreads=None, strPrecision='auto',
+                     isChannelsLast=None, intModelCacheSize=None):
+    """设置推理设备和CPU性能参数，strDevice为空时有GPU用GPU，否则用CPU
+    intThreads/intInteropThreads为算子内/算子间线程数；strPrecision为'auto'、'fp32'或'bf16'，
+    'auto'只在支持bfloat16指令的CPU上启用自动混合精度；isChannelsLast为空时CPU上默认使用channels_last；
+    intModelCacheSize为最多缓存的模型数"""
+    device = torch.device(strDevice or ("cuda" if torch.cuda.is_available() else "cpu"))
+    if intThreads:
+        torch.set_num_threads(intThreads)
+    if intInteropThreads:
+        try:
+            torch.set_num_interop_threads(intInteropThreads)
+        except RuntimeError:
+            # 算子间线程池启动后不能再修改
+            print("算子间线程数已固定为{}".format(torch.get_num_interop_threads()))
+    isBf16 = strPrecision == 'bf16' or (strPrecision == 'auto' and device.type == 'cpu' and _cpuSupportsBf16())
+    _dictRuntime.update(device=device, bf16=isBf16,
+                        channels_last=device.type == 'cpu' if isChannelsLast is None else isChannelsLast)
+    if intModelCacheSize:
+        _dictRuntime['model_cache_size'] = intModelCacheSize
+    _dictModelCache.clear()  # 已加载的模型属于旧设置
+    print("推理设备{}，线程数{}/{}，bfloat16 {}，channels_last {}".format(
+        device, torch.get_num_threads(), torch.get_num_interop_threads(), isBf16, _dictRuntime['channels_last']))
+
+
+def getRuntime():
+    if _dictRuntime['device'] is None:
+        configureRuntime()
+    return _dictRuntime
+
+
+def fuseConvBn(model, tensorExample):
+    """把推理模式下紧跟在卷积后的BatchNorm2d折叠进卷积权重，对应的BN替换为Identity
+    通过一次前向传播找出"BN的输入恰好是某个卷积的输出且该输出没有其他模块使用"的卷积-BN对，
+    融合后结果与原模型不一致时放弃融合"""
+    dictNames = {module: strName for strName, module in model.named_modules()}
+    dictProducers = {}  # id(输出张量) -> 卷积名
+    dictConsumers = {}  # id(输入张量) -> 使用该张量的模块名列表
+    listPairs = []
+    listKeep = []  # 保持张量存活，避免id被复用
+
+    def hook(module, inputs, output):
+        strName = dictNames[module]
+        listKeep.extend([inputs[0], output])
+        dictConsumers.setdefault(id(inputs[0]), []).append(strName)
+        if isinstance(module, nn.Conv2d):
+            dictProducers[id(output)] = strName
+        elif isinstance(module, nn.BatchNorm2d) and id(inputs[0]) in dictProducers:
+            listPairs.append((dictProducers[id(inputs[0])], strName, id(inputs[0])))
+
+    listHandles = [module.register_forward_hook(hook) for module in model.modules()
+                   if len(list(module.children())) == 0 and not isinstance(module, nn.Identity)]
+    try:
+        with torch.inference_mode():
+            tensorReference = model(tensorExample)
+    finally:
+        for handle in listHandles:
+            handle.remove()
+
+    # 同一卷积被多次调用或输出另有它用时不能融合
+    listConvs = [strConv for strConv, _, _ in listPairs]
+    listPairs = [(strConv, strBn) for strConv, strBn, intTensor in listPairs
+                 if listConvs.count(strConv) == 1 and len(dictConsumers[intTensor]) == 1]
+    if not listPairs:
+        return model
+
+    modelFused = copy.deepcopy(model)
+    dictModules = dict(modelFused.named_modules())
+    for strConv, strBn in listPairs:
+        convFused = fuse_conv_bn_eval(dictModules[strConv], dictModules[strBn])
+        for strName, module in ((strConv, convFused), (strBn, nn.Identity())):
+            strParent, _, strAttr = strName.rpartition('.')
+            setattr(dictModules[strParent] if strParent else modelFused, strAttr, module)
+
+    with torch.inference_mode():
+        tensorFused = modelFused(tensorExample)
+    dblTolerance = 1e-3 * max(1.0, tensorReference.abs().max().item())
+    if not torch.allclose(tensorFused, tensorReference, rtol=1e-3, atol=dblTolerance):
+        print("卷积与BN融合后结果不一致，使用未融合的模型")
+        return model
+    print("融合了{}组卷积与BN".format(len(listPairs)))
+    return modelFused
+
+
+def optimizeModel(model, intExampleSize=256):
+    """把模型移动到推理设备，融合卷积与BN，CPU上按需转换为channels_last内存格式"""
+    dictRuntime = getRuntime()
+    model = model.to(dictRuntime['device']).eval()
+    model = fuseConvBn(model, torch.rand(1, 3, intExampleSize, intExampleSize, device=dictRuntime['device']))
+    if dictRuntime['channels_last']:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def prefetchBatches(iterItems, intBatchSize, funcLoad, intPrefetch=2, isPinMemory=False):
+    """从iterItems中依次取出intBatchSize个元素，由后台线程调用funcLoad(元素列表)生成批次张量，
+    当前批次计算时预先准备后续intPrefetch个批次，返回(元素列表, 批次张量)"""
+    def loadBatch(listItems):
+        tensorBatch = funcLoad(listItems)
+        return listItems, tensorBatch.pin_memory() if isPinMemory else tensorBatch
+
+    iterItems = iter(iterItems)
+    with ThreadPoolExecutor(max_workers=intPrefetch + 1) as executor:
+        futures = deque()
+        for listItems in iter(lambda: list(islice(iterItems, intBatchSize)), []):
+            futures.append(executor.submit(loadBatch, listItems))
+            if len(futures) > intPrefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def iterBatches(root_path, images, intBatchSize, intPrefetch=2, isPinMemory=False):
+    """后台线程解码root_path下的切片文件并组成批次，返回(文件名列表, 批次张量)"""
+    def loadFiles(listNames):
+        return torch.stack([transform(Image.open(os.path.join(root_path, name))).float() for name in listNames])
+
+    return prefetchBatches(images, intBatchSize, loadFiles, intPrefetch, isPinMemory)
+
+
+def cropToRGB(npCrop, isGdalRead):
+    """GDAL读取的影像已是RGB顺序，OpenCV读取的BGR(A)影像转换为RGB(A)，与切片写成PNG后再用PIL读取的结果一致"""
+    if isGdalRead or npCrop.ndim != 3 or npCrop.shape[2] not in (3, 4):
+        return npCrop
+    return cv2.cvtColor(npCrop, cv2.COLOR_BGR2RGB if npCrop.shape[2] == 3 else cv2.COLOR_BGRA2RGBA)
+
+
+def toBGR(npImage, isGdalRead):
+    """转换为与cv2.imread相同的3通道BGR：单波段复制为3通道，GDAL读取的RGB取前3个波段后转换为BGR，OpenCV读取的去掉alpha"""
+    if npImage.ndim == 2:
+        npImage = npImage[:, :, None]
+    if npImage.shape[2] < 3:
+        return np.repeat(npImage[:, :, :1], 3, axis=2)
+    return np.ascontiguousarray(npImage[:, :, 2::-1] if isGdalRead else npImage[:, :, :3])
+
+
+def loadCropBatch(listTiles):
+    # listTiles为ImageManager.iterCrops生成的(组号, 行, 列, 切片)
+    return torch.stack([transform(cropToRGB(objCrop.npImageData, objCrop.isGdalRead)).float()
+                        for _, _, _, objCrop in listTiles])
+
+
+def availableMemory():
+    """返回可用内存字节数，无法获取时返回None"""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def autoBatchSize(intTileSize=512):
+    """按空闲显存估计批大小（每个512切片约预留400MB），显存不足时由forwardBatch继续减半；
+    CPU上按可用内存的一半估计，批再大也不会更快，最多16"""
+    intPerTile = 400 * 1024 ** 2 * (intTileSize / 512) ** 2
+    if not torch.cuda.is_available():
+        intFree = availableMemory()
+        if intFree is None:
+            return 4
+        return int(max(1, min(16, intFree // 2 // intPerTile)))
+    intFree, _ = torch.cuda.mem_get_info()
+    return int(max(1, min(32, intFree // intPerTile)))
+
+
+def forwardBatch(model, images, dictState):
+    """分块前向推理，显存不足时把dictState['batch_size']减半后重试，返回每个切片的类别图"""
+    dictRuntime = getRuntime()
+    device = dictRuntime['device']
+    memoryFormat = torch.channels_last if dictRuntime['channels_last'] else torch.contiguous_format
+    listPreds = []
+    i = 0
+    while i < len(images):
+        chunk = images[i:i + dictState['batch_size']]
+        try:
+            if isinstance(model, OrtModel):
+                # ONNX Runtime自行管理设备与精度，输入留在CPU上
+                output = model(chunk)
+            else:
+                with torch.autocast(device.type, dtype=torch.bfloat16, enabled=dictRuntime['bf16']):
+                    output = model(chunk.to(device, non_blocking=True, memory_format=memoryFormat))
+        except torch.cuda.OutOfMemoryError:
+            if dictState['batch_size'] == 1:
+                raise
+            dictState['batch_size'] //= 2
+            torch.cuda.empty_cache()
+            print("显存不足，批大小降为{}".format(dictState['batch_size']))
+            continue
+        _, pred = output.max(1)
+        listPreds.append(pred.to(torch.uint8).cpu().numpy())
+        i += len(chunk)
+    return np.concatenate(listPreds)
+
+
+def saveTilePrediction(config, image_name, mask_im, npLut):
+    pre_base_path = config['pre_dir']
     file_name = image_name.split('\\')[-1]
-    save_label = os.path.join(pre_mask_path, file_name)
-    await write_image_async(save_label, mask_im)
-    print("写入{}成功".format(save_label))
-    save_visual = os.path.join(pre_vis_path, file_name)
-    print("开始写入{}".format(save_visual))
-    translabeltovisual(save_label, save_visual, num_classes)
-    print("写入{}成功".format(save_visual))
+    save_label = os.path.join(pre_base_path, 'mask', file_name)
+    cv2.imwrite(save_label, mask_im)
+    save_visual = os.path.join(pre_base_path, 'vis', file_name)
+    cv2.imwrite(save_visual, labelToVisual(mask_im, npLut))
 
 
-def load_model(config):
-    device = torch.device('cuda:0')
-    selected = config['predict_model']['model'][config['predict_model']['select']]
+def dumpTilePrediction(strDebugDir, strName, npRGB, mask_im, npLut):
+    """调试用：把流式预测的切片、类别图和可视化图按磁盘模式的目录结构写到strDebugDir"""
+    npCrop = cv2.cvtColor(npRGB, cv2.COLOR_RGB2BGR) if npRGB.ndim == 3 and npRGB.shape[2] == 3 else npRGB
+    cv2.imwrite(os.path.join(strDebugDir, strName + '.png'), npCrop)
+    cv2.imwrite(os.path.join(strDebugDir, 'mask', strName + '.png'), mask_im)
+    cv2.imwrite(os.path.join(strDebugDir, 'vis', strName + '.png'), labelToVisual(mask_im, npLut))
+
+
+def _weightsHash(check_point):
+    stat = os.stat(check_point)
+    tupleKey = (os.path.abspath(check_point), stat.st_mtime_ns, stat.st_size)
+    if tupleKey not in _dictWeightsHash:
+        sha1 = hashlib.sha1()
+        with open(check_point, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        _dictWeightsHash[tupleKey] = sha1.hexdigest()
+    return _dictWeightsHash[tupleKey]
+
+
+def buildModel(selected, num_classes, isPretrained=True, strAttention='sdpa'):
+    # isPretrained=False时LinkNet的ResNet编码器随机初始化，不下载ImageNet权重
+    # strAttention为LinkNet非局部块的注意力实现（'dense'、'sdpa'或'chunked'）
     if selected == 'SGCNNet':
-        model = SGCNNet.SGCN_res50(num_classes=config['num_classes'])
+        model = SGCNNet.SGCN_res50(num_classes=num_classes)
     elif selected == 'LinkNet':
-        model = NlLinkNet.NL34_LinkNet()
+        model = NlLinkNet.NL34_LinkNet(pretrained=isPretrained, attention=strAttention)
     elif selected == 'UNet':
         model = UNet.UNET()
+    return model
+
 
+class OrtModel:
+    """ONNX Runtime推理后端，接口与PyTorch模型一致：输入NCHW张量，返回logits张量"""
+
+    def __init__(self, check_point, device):
+        import onnxruntime as ort  # 只有选择onnx后端时才需要安装
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = torch.get_num_interop_threads()
+        listProviders = ['CPUExecutionProvider']
+        if device.type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+            listProviders.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(check_point, options, providers=listProviders)
+        self.strInput = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        npImages = images.detach().cpu().float().contiguous().numpy()
+        return torch.from_numpy(self.session.run(None, {self.strInput: npImages})[0])
+
+
+def load_model(config):
+    selected = config['predict_model']['model'][config['predict_model']['select']]
     if config['userWeights']:
         check_point =  os.path.join(config['save_model']['save_path'],config['weights'])
     else:
         check_point = os.path.join(config['save_model']['save_path'],
                                    selected + '_' + config['extraction_type'] + '.pth')
+    strBackend = config.get('backend') or 'torch'
+    if check_point.lower().endswith('.onnx'):
+        # 上传的ONNX权重（包括量化后的int8模型）只能由ONNX Runtime执行
+        strBackend = 'onnx'
+    elif strBackend == 'onnx':
+        # 与权重同名的.onnx文件由export_onnx.py导出
+        check_point = os.path.splitext(check_point)[0] + '.onnx'
+    strAttention = config.get('attention') or 'sdpa'
+    tupleKey = (selected, config['num_classes'], _weightsHash(check_point), strBackend, strAttention)
+    if tupleKey in _dictModelCache:
+        _dictModelCache.move_to_end(tupleKey)
+        return _dictModelCache[tupleKey]
+
+    if strBackend == 'onnx':
+        model = OrtModel(check_point, getRuntime()['device'])
+    else:
+        model = buildModel(selected, config['num_classes'], isPretrained=False, strAttention=strAttention)
+        # GPU上保存的权重也能在CPU节点上加载
+        model.load_state_dict(torch.load(check_point, map_location='cpu'), False)
+        model = optimizeModel(model)
     print("加载模型{}成功".format(check_point))
-    model.load_state_dict(torch.load(check_point), False)
-    model.cuda()
-    model.eval()
+    _dictModelCache[tupleKey] = model
+    while len(_dictModelCache) > getRuntime()['model_cache_size']:
+        _dictModelCache.popitem(last=False)
     return model
 
 
-def translabeltovisual(save_label, path, num_classes):
-    im = cv2.imread(save_label)
-    im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-    for i in range(im.shape[0]):
-        for j in range(im.shape[1]):
-            pred_class = im[i][j][0]
-            im[i][j] = num_classes[pred_class]
-    im = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
-    cv2.imwrite(path, im)
-
-
-async def write_image_async(file_path, image_array):
-    with open(file_path, 'wb') as f:
-        ret, buffer = cv2.imencode('.png', image_array)
-        f.write(buffer.tobytes())
+def makePaletteLut(palette):
+    """把[[R, G, B], ...]调色板转换为256项BGR查找表，调色板未覆盖的类别按PASCAL VOC配色补齐"""
+    npIndex = np.arange(256)
+    npLut = np.zeros((256, 3), dtype=np.uint8)
+    for intBit in range(8):
+        for intChannel in range(3):
+            npLut[:, intChannel] |= (((npIndex >> (3 * intBit + intChannel)) & 1) << (7 - intBit)).astype(np.uint8)
+    npLut[:len(palette)] = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+    return np.ascontiguousarray(npLut[:, ::-1])
 
 
-with open('config.json', 'r', encoding='utf-8') as f:
-    df = json.load(f)
+def labelToVisual(mask_im, npLut):
+    """一次查表把类别图(H, W)渲染为BGR可视化图"""
+    return npLut[mask_im]
 
-Manager = ImageManager()
 
-Manager.readImg(df['FileName'])
-Manager.cropImg(intWidth=512, intHeight=512, intStep=256, intStartGroup=1)
-Manager.saveImg('./Crops', Manager.dictCroppedImages, '.png', formEE=False)
+def translabeltovisual(save_label, path, num_classes):
+    im = cv2.imread(save_label, cv2.IMREAD_GRAYSCALE)
+    cv2.imwrite(path, labelToVisual(im, makePaletteLut(num_classes)))
 
-with open('Predict.txt', 'w') as f:
-    for key in Manager.dictCroppedImages.keys():
-        f.writelines(key + '.png\n')
 
 # 定义一个字符串映射字典
 MapPing = {
@@ -116,46 +365,74 @@ MapPing = {
     "耕地": "cul",
 }
 
-if df['Weights'] is None:
+
+def buildPredictConfig(df, strWeightsDir='./'):
+    """由前端的预测参数生成预测配置，用户权重位于strWeightsDir，默认权重位于defaultModelWeights"""
     PredictConfig = {
         "num_classes": 2,
+        "palette": df.get('Palette') or [[0, 0, 0], [255, 255, 255]],  # 各类别的可视化颜色(RGB)
         "pre_dir": "Crops",
         "img_txt": "Predict.txt",
-        "img_height": 512,
-        "img_width": 512,
+        "img_height": df.get('TileSize') or 512,
+        "img_width": df.get('TileSize') or 512,
+        "img_step": df.get('TileStep') or 256,  # 裁剪步长，相邻切片重叠img_width - img_step个像素
+        "stream": df.get('Stream', True),  # 为False时切片和预测结果经Crops目录中转（旧流程）
+        "debug_dir": df.get('DebugDir'),  # 流式预测时写出中间PNG的目录，应为绝对路径（工作目录在任务结束后删除）
+        "batch_size": df.get('BatchSize'),  # 为空时按空闲显存自动选择
+        "backend": df.get('Backend') or 'torch',  # 'torch'或'onnx'（ONNX Runtime）
+        "attention": df.get('Attention') or 'sdpa',  # LinkNet非局部块的注意力实现，dense为原来的完整矩阵实现
         "predict_model": {
             "select": 0,
             "model": [df['ModelName']]
         },
-        "userWeights": False,
         "extraction_type": MapPing[df['Extraction']],
-        "save_model": {
+    }
+    if df['Weights'] is None:
+        PredictConfig["userWeights"] = False
+        PredictConfig["save_model"] = {
             "save": "true",
-            "save_path": "./defaultModelWeights"
+            "save_path": os.path.join(MODEL_TRAINER_DIR, "defaultModelWeights")
         }
-    }
-elif df['Weights'] is not None:
-    PredictConfig = {
-        "num_classes": 2,
-        "pre_dir": "Crops",
-        "img_txt": "Predict.txt",
-        "img_height": 512,
-        "img_width": 512,
-        "predict_model": {
-            "select": 0,
-            "model": [df['ModelName']]
-        },
-        "extraction_type": MapPing[df['Extraction']],
-        "userWeights": True,
-        "weights": df['Weights'],
-        "save_model": {
+    else:
+        PredictConfig["userWeights"] = True
+        PredictConfig["weights"] = df['Weights']
+        PredictConfig["save_model"] = {
             "save": "true",
-            "save_path": "./"
+            "save_path": strWeightsDir
         }
-    }
+    return PredictConfig
+
+
+def checkBatchParity(model, intTileSize=128):
+    """检查成批推理与逐个切片推理的类别图是否一致（同批切片不应相互影响），结果记录在模型上只检查一次"""
+    isConsistent = getattr(model, 'isBatchConsistent', None)
+    if isConsistent is None:
+        images = torch.rand(2, 3, intTileSize, intTileSize)
+        with torch.inference_mode():
+            npBatch = forwardBatch(model, images, {'batch_size': 2})
+            npSingle = forwardBatch(model, images, {'batch_size': 1})
+        # bf16下个别接近平局的像素可能不同
+        isConsistent = bool(np.mean(npBatch != npSingle) < 1e-3)
+        model.isBatchConsistent = isConsistent
+    return isConsistent
+
 
+def initBatchState(config, model):
+    dictState = {'batch_size': config.get('batch_size') or autoBatchSize(config['img_width'])}
+    # SGCNNet的Sobel分支使用未指定维度的nn.Softmax()，对(b, c, c)输入会沿批维度归一化，
+    # 同批切片的结果会相互影响；已有权重都按这一行为训练，因此逐个切片推理，保持与单张预测一致
+    if config['predict_model']['model'][config['predict_model']['select']] == 'SGCNNet':
+        dictState['batch_size'] = 1
+    if dictState['batch_size'] > 1 and not checkBatchParity(model):
+        print("成批推理与逐个切片推理结果不一致，逐个切片推理")
+        dictState['batch_size'] = 1
+    return dictState
 
-async def predict(config, num_classes):
+
+def predict(config, num_classes, funcProgress=None):
+    """批量预测pre_dir下img_txt列出的所有切片，解码、推理和写出三者并行，num_classes为各类别的可视化颜色[[R, G, B], ...]
+    funcProgress(阶段, 已完成数, 总数)在每个批次完成后调用"""
+    funcProgress = funcProgress or (lambda *args: None)
     pre_base_path = config['pre_dir']
     pre_mask_path = os.path.join(pre_base_path, 'mask')
     pre_vis_path = os.path.join(pre_base_path, 'vis')
@@ -166,36 +443,141 @@ async def predict(config, num_classes):
     if os.path.exists(pre_vis_path) is False:
         os.makedirs(pre_vis_path)
 
-    async with aiofiles.open(config['img_txt'], 'r', encoding='utf-8') as f:
-        images = await f.readlines()
-
-    tasks = []
-    for image in images:
-        task = asyncio.create_task(predict_single_image(config, image.strip(), num_classes))
-        tasks.append(task)
-    await asyncio.gather(*tasks)
-
-
-asyncio.run(predict(PredictConfig, [[0, 0, 0], [255, 255, 255]]))
-
-obj_Manager = ImageManager()
-obj_Manager.readImg('./Crops/vis')
-Manager.dictCroppedImages = obj_Manager.dictImages
-Manager.stitchImg(intWidth=512, intHeight=512, intStep=256)
-if df['FileName'].lower().endswith(('.tif', '.tiff')):
-    Manager.savePredicted('./Predicted', Manager.dictStitchedImages, '.tif', formEE=False)
-    strMaskName = Path(df['FileName']).stem + '_ori.tif'
-else:
-    Manager.savePredicted('./Predicted', Manager.dictStitchedImages, '.png', formEE=False)
-    strMaskName = Path(df['FileName']).stem + '_ori.png'
-print('Predict Success!')
-
-strMaskPath = './Predicted/' + strMaskName
-strSavePath ='./Predicted/' + Path(df['FileName']).stem + '_mix.png'
-Mask = cv2.imread(strMaskPath)
-Origin = cv2.imread(df['FileName'])
-combine = cv2.addWeighted(Origin,0.5,Mask,0.5,0)
-cv2.imwrite(strSavePath,combine)
-
-shutil.copy2(strMaskPath,'../../assets/')
-shutil.copy2(strSavePath,'../../assets/')
\ No newline at end of file
+    with open(config['img_txt'], 'r', encoding='utf-8') as f:
+        images = [line.strip() for line in f if line.strip()]
+
+    model = load_model(config)
+    device = getRuntime()['device']
+    npLut = makePaletteLut(num_classes)
+    dictState = initBatchState(config, model)
+    print("批大小{}，共{}个切片".format(dictState['batch_size'], len(images)))
+
+    funcProgress('predict', 0, len(images))
+    with torch.inference_mode(), ThreadPoolExecutor() as writer:
+        futures = []
+        for listNames, tensorBatch in iterBatches(pre_base_path, images, dictState['batch_size'],
+                                                  isPinMemory=device.type == 'cuda'):
+            preds = forwardBatch(model, tensorBatch, dictState)
+            futures.extend(writer.submit(saveTilePrediction, config, name, mask_im, npLut)
+                           for name, mask_im in zip(listNames, preds))
+            funcProgress('predict', len(futures), len(images))
+        for future in futures:
+            future.result()
+
+
+def predictStream(config, Manager, num_classes, funcProgress=None):
+    """流式预测：切片从Manager.dictImages中逐块取出，经归一化、批量推理后直接放入拼接累加器，
+    全程不写中间文件，结果保存在Manager.dictStitchedImages中。config['debug_dir']不为空时额外写出中间PNG"""
+    funcProgress = funcProgress or (lambda *args: None)
+    intWidth, intHeight, intStep = config['img_width'], config['img_height'], config['img_step']
+    strDebugDir = config.get('debug_dir')
+    if strDebugDir:
+        os.makedirs(os.path.join(strDebugDir, 'mask'), exist_ok=True)
+        os.makedirs(os.path.join(strDebugDir, 'vis'), exist_ok=True)
+
+    model = load_model(config)
+    device = getRuntime()['device']
+    npLut = makePaletteLut(num_classes)
+    dictState = initBatchState(config, model)
+    print("批大小{}，流式预测{}幅影像".format(dictState['batch_size'], len(Manager.dictImages)))
+
+    objGrid = TileGrid(intWidth, intHeight, intStep)
+    dictAccumulators = {}  # 组号 -> 拼接累加器
+    intTotal = sum(-(-intImgH // intStep) * -(-intImgW // intStep)
+                   for intImgH, intImgW in (obj.tupleOriginalShape[:2] for obj in Manager.dictImages.values()))
+    intDone = 0
+    funcProgress('predict', 0, intTotal)
+    with torch.inference_mode(), ThreadPoolExecutor() as writer:
+        futures = []
+        iterTiles = Manager.iterCrops(intWidth, intHeight, intStep)
+        for listTiles, tensorBatch in prefetchBatches(iterTiles, dictState['batch_size'], loadCropBatch,
+                                                      isPinMemory=device.type == 'cuda'):
+            preds = forwardBatch(model, tensorBatch, dictState)
+            # 按iterCrops的行优先顺序放入瓦片，重叠区域与stitchImg一样由后面的瓦片覆盖
+            for (intGroup, intRow, intCol, objCrop), mask_im in zip(listTiles, preds):
+                if intGroup not in dictAccumulators:
+                    dictAccumulators[intGroup] = StitchAccumulator(objCrop.tupleOriginalShape, None, objCrop.prj,
+                                                                   objCrop.geoTransform)
+                intXOff, intYOff = objGrid.getTileOffset(intRow, intCol)
+                dictAccumulators[intGroup].addTile(labelToVisual(mask_im, npLut), intXOff, intYOff)
+                if strDebugDir:
+                    futures.append(writer.submit(dumpTilePrediction, strDebugDir, objCrop.strImageName,
+                                                 cropToRGB(objCrop.npImageData, objCrop.isGdalRead), mask_im, npLut))
+            intDone += len(listTiles)
+            funcProgress('predict', intDone, intTotal)
+        for future in futures:
+            future.result()
+
+    Manager.dictStitchedImages.clear()
+    for intGroup, (strImgName, objImageData) in enumerate(Manager.dictImages.items(), 1):
+        objAccumulator = dictAccumulators.get(intGroup) or StitchAccumulator(objImageData.tupleOriginalShape)
+        Manager.dictStitchedImages[strImgName] = ProcessedImageData(
+            strImgName, objAccumulator.close(), objImageData.tupleOriginalShape, "stitched", objImageData.prj,
+            objImageData.geoTransform, objImageData.isGdalRead)
+
+
+def predictImage(df, strWeightsDir='./', strAssetsDir='../../assets/', funcProgress=None):
+    """在当前工作目录下完成裁剪、预测、拼接与叠加，结果复制到strAssetsDir，返回结果文件名
+    funcProgress(阶段, 已完成数, 总数)报告进度，阶段依次为read、predict（按切片计数）、stitch、save"""
+    funcProgress = funcProgress or (lambda *args: None)
+    Manager = ImageManager()
+    funcProgress('read', 0, 1)
+    # GeoTIFF只打开数据集，切片和叠加图都按窗口读取，不把整幅影像读入内存
+    Manager.readImg(df['FileName'], lazy=True)
+    try:
+        PredictConfig = buildPredictConfig(df, strWeightsDir)
+        intWidth, intHeight, intStep = PredictConfig['img_width'], PredictConfig['img_height'], PredictConfig['img_step']
+
+        if PredictConfig['stream']:
+            predictStream(PredictConfig, Manager, PredictConfig['palette'], funcProgress)
+        else:
+            # 磁盘模式：切片、类别图和可视化图都经过Crops目录中转
+            Manager.cropImg(intWidth=intWidth, intHeight=intHeight, intStep=intStep, intStartGroup=1)
+            Manager.saveImg('./Crops', Manager.dictCroppedImages, '.png', formEE=False, intPngCompression=1)
+
+            with open('Predict.txt', 'w') as f:
+                for key in Manager.dictCroppedImages.keys():
+                    f.writelines(key + '.png\n')
+
+            predict(PredictConfig, PredictConfig['palette'], funcProgress)
+
+            funcProgress('stitch', 0, 1)
+            obj_Manager = ImageManager()
+            obj_Manager.readImg('./Crops/vis')
+            Manager.dictCroppedImages = obj_Manager.dictImages
+            Manager.stitchImg(intWidth=intWidth, intHeight=intHeight, intStep=intStep)
+
+        funcProgress('save', 0, 1)
+        if df['FileName'].lower().endswith(('.tif', '.tiff')):
+            Manager.savePredicted('./Predicted', Manager.dictStitchedImages, '.tif', formEE=False)
+            strMaskName = Path(df['FileName']).stem + '_ori.tif'
+        else:
+            Manager.savePredicted('./Predicted', Manager.dictStitchedImages, '.png', formEE=False)
+            strMaskName = Path(df['FileName']).stem + '_ori.png'
+        print('Predict Success!')
+
+        strMaskPath = './Predicted/' + strMaskName
+        strMixName = Path(df['FileName']).stem + '_mix.png'
+        strSavePath = './Predicted/' + strMixName
+        # 拼接结果就是写出文件按OpenCV读回的BGR数据，与源影像逐窗口叠加
+        Mask = next(iter(Manager.dictStitchedImages.values())).npImageData
+        objSource = next(iter(Manager.dictImages.values()))
+        combine = np.empty_like(Mask)
+        for intXOff, intYOff, intW, intH in objSource.iterWindows():
+            npOrigin = toBGR(objSource.readWindow(intXOff, intYOff, intW, intH), objSource.isGdalRead)
+            combine[intYOff:intYOff + intH, intXOff:intXOff + intW] = cv2.addWeighted(
+                npOrigin, 0.5, Mask[intYOff:intYOff + intH, intXOff:intXOff + intW], 0.5, 0)
+        cv2.imwrite(strSavePath,combine)
+    finally:
+        # 出错时同样释放源影像的句柄，常驻工作进程中不残留
+        Manager.close()
+
+    shutil.copy2(strMaskPath, strAssetsDir)
+    shutil.copy2(strSavePath, strAssetsDir)
+    return {"Mixture": strMixName, "Origin": strMaskName}
+
+
+if __name__ == '__main__':
+    with open('config.json', 'r', encoding='utf-8') as f:
+        df = json.load(f)
+    predictImage(df)
@@ -0,0 +1,126 @@
+"""分割模型的训练后int8量化：先导出ONNX，再用ONNX Runtime做动态或静态量化，最后与fp32模型对比精度和速度
+
+静态量化用数据集列表（与训练相同的"影像\t标签"格式，路径相对dataset/）中的切片校准激活值范围，
+动态量化只量化权重、推理时再统计激活值。量化后的.onnx可直接作为预测参数Weights上传使用。
+
+用法：
+    python quantize_onnx.py --model SGCNNet --weights SGCNNet_road.pth --calib train.txt --eval test.txt
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quantize_dynamic, quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from torch.utils.data import DataLoader
+
+from export_onnx import exportOnnx
+from metrics import ConfusionMatrix
+from predictor import OrtModel, transform
+from utils import dataset
+
+
+class TileCalibrationReader(CalibrationDataReader):
+    """从数据集列表中等间隔取intTiles个切片，逐个提供给ONNX Runtime的校准器"""
+
+    def __init__(self, strListPath, intTiles=64, strInputName='input'):
+        self.dataset = dataset.Dataset(strListPath, transform=transform, device='cpu')
+        intTiles = min(intTiles, len(self.dataset))
+        self.listIndices = np.linspace(0, len(self.dataset) - 1, intTiles).astype(int).tolist()
+        self.strInputName = strInputName
+        self.intPosition = 0
+
+    def get_next(self):
+        if self.intPosition >= len(self.listIndices):
+            return None
+        image, _ = self.dataset[self.listIndices[self.intPosition]]
+        self.intPosition += 1
+        return {self.strInputName: image.unsqueeze(0).numpy()}
+
+    def rewind(self):
+        self.intPosition = 0
+
+
+def quantizeModel(strModelName, strWeights, strCalibList=None, strMode='static', strOutPath=None, num_classes=2,
+                  intCalibTiles=64, intSize=512):
+    """导出并量化模型，返回(fp32模型路径, int8模型路径)；strMode为'static'时需要strCalibList"""
+    strFp32Path = exportOnnx(strModelName, strWeights, None, num_classes, intSize)
+    strOutPath = strOutPath or os.path.splitext(strWeights)[0] + '_int8.onnx'
+    # 量化前先做形状推断和图优化；符号形状推断只对Transformer类模型有用，且无法处理动态宽高，跳过
+    strPrepared = os.path.splitext(strFp32Path)[0] + '.prep.onnx'
+    quant_pre_process(strFp32Path, strPrepared, skip_symbolic_shape=True)
+
+    try:
+        if strMode == 'dynamic':
+            quantize_dynamic(strPrepared, strOutPath, weight_type=QuantType.QInt8)
+        elif strMode == 'static':
+            if strCalibList is None:
+                raise ValueError("静态量化需要校准数据列表")
+            reader = TileCalibrationReader(strCalibList, intCalibTiles)
+            # 卷积权重逐通道量化，激活值按MinMax校准为uint8
+            quantize_static(strPrepared, strOutPath, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                            calibrate_method=CalibrationMethod.MinMax)
+        else:
+            raise ValueError(f"Unknown quantization mode: {strMode}")
+    finally:
+        os.remove(strPrepared)
+    print("{}量化模型已保存到{}".format(strMode, strOutPath))
+    return strFp32Path, strOutPath
+
+
+def evaluateModel(model, dataloader, num_classes):
+    """返回(OA, mIoU, 每秒切片数)，精度统计方式与train.py相同"""
+    conf_matrix = ConfusionMatrix(num_classes)
+    dblElapsed, intTiles = 0.0, 0
+    for data, target in dataloader:
+        dblStart = time.perf_counter()
+        output = model(data)
+        dblElapsed += time.perf_counter() - dblStart
+        intTiles += len(data)
+        conf_matrix.update(output, target)
+    dictMetrics = conf_matrix.compute()
+    return dictMetrics['OA'], dictMetrics['mIoU'], intTiles / max(dblElapsed, 1e-6)
+
+
+def compareModels(strFp32Path, strInt8Path, strEvalList, num_classes=2, intBatchSize=4):
+    """在评估列表上对比fp32与int8模型的OA、mIoU、吞吐量和文件大小，打印并返回报告"""
+    dataloader = DataLoader(dataset.Dataset(strEvalList, transform=transform, device='cpu'), shuffle=False,
+                            batch_size=intBatchSize)
+    dictReport = {}
+    for strName, strPath in (('fp32', strFp32Path), ('int8', strInt8Path)):
+        pixelAcc, mIoU, dblSpeed = evaluateModel(OrtModel(strPath, torch.device('cpu')), dataloader, num_classes)
+        dictReport[strName] = {"OA": float(pixelAcc), "mIoU": float(mIoU), "tiles_per_second": dblSpeed,
+                               "size_mb": os.path.getsize(strPath) / 1024 ** 2}
+        print("{}: OA {:.5f} mIoU {:.5f} | {:.2f}切片/秒 | {:.1f} MB".format(
+            strName, pixelAcc, mIoU, dblSpeed, dictReport[strName]["size_mb"]))
+
+    dictFp32, dictInt8 = dictReport['fp32'], dictReport['int8']
+    dictReport["delta"] = {"OA": dictInt8["OA"] - dictFp32["OA"], "mIoU": dictInt8["mIoU"] - dictFp32["mIoU"],
+                           "speedup": dictInt8["tiles_per_second"] / dictFp32["tiles_per_second"],
+                           "size_ratio": dictFp32["size_mb"] / dictInt8["size_mb"]}
+    print("ΔOA {OA:+.5f} ΔmIoU {mIoU:+.5f} | 加速{speedup:.2f}倍 | 体积缩小{size_ratio:.2f}倍".format(
+        **dictReport["delta"]))
+    return dictReport
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="分割模型int8量化并与fp32对比")
+    parser.add_argument('--model', required=True, choices=['SGCNNet', 'LinkNet', 'UNet'])
+    parser.add_argument('--weights', required=True, help="fp32的.pth权重文件")
+    parser.add_argument('--mode', default='static', choices=['static', 'dynamic'])
+    parser.add_argument('--calib', default=None, help="静态量化的校准数据列表")
+    parser.add_argument('--calib-tiles', type=int, default=64)
+    parser.add_argument('--eval', default=None, help="精度对比使用的数据列表，为空时不对比")
+    parser.add_argument('--output', default=None, help="输出的.onnx文件，默认为<权重名>_int8.onnx")
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--size', type=int, default=512)
+    args = parser.parse_args()
+
+    strFp32Path, strInt8Path = quantizeModel(args.model, args.weights, args.calib, args.mode, args.output,
+                                             args.num_classes, args.calib_tiles, args.size)
+    if args.eval:
+        compareModels(strFp32Path, strInt8Path, args.eval, args.num_classes)
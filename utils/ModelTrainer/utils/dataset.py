@@ -17,21 +17,54 @@ def read_txt(path):
     return ims, labels
 
 class Dataset(Dataset):
-    def __init__(self, txtpath, transform):
+    def __init__(self, txtpath, transform, device=None, cache_bytes=0):
         super().__init__()
         self.ims, self.labels = read_txt(txtpath)
         self.transform = transform
+        # 未指定设备时有GPU用GPU，否则留在CPU上；DataLoader多进程加载时应为'cpu'，由训练循环搬运到GPU
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        # cache_bytes > 0且整个数据集解码后不超过该大小时，解码结果缓存在共享内存中，各加载进程共用
+        self.cache = None
+        if cache_bytes > 0 and len(self) > 0:
+            self._init_cache(cache_bytes)
 
-    def __getitem__(self, index):
-        
-        im_path = self.ims[index]
-        label_path = self.labels[index]
+    def _decode(self, index):
+        return np.array(Image.open(self.ims[index])), np.array(Image.open(self.labels[index]))
+
+    def _init_cache(self, cache_bytes):
+        # 以第一个样本的尺寸预分配，尺寸不同的样本不缓存
+        image, label = self._decode(0)
+        total_bytes = len(self) * (image.nbytes + label.nbytes)
+        if total_bytes > cache_bytes:
+            print("数据集解码后约{:.0f}MB，超过缓存上限{:.0f}MB，不缓存".format(total_bytes / 1024 ** 2,
+                                                                     cache_bytes / 1024 ** 2))
+            return
+        self.cache = {
+            "images": torch.from_numpy(image).new_empty((len(self),) + image.shape).share_memory_(),
+            "labels": torch.from_numpy(label).new_empty((len(self),) + label.shape).share_memory_(),
+            "filled": torch.zeros(len(self), dtype=torch.bool).share_memory_(),
+        }
 
-        image = Image.open(im_path)
-        image = self.transform(image).float().cuda()
-        label = torch.from_numpy(np.asarray(Image.open(label_path), dtype=np.int32)).long().cuda()
+    def _load(self, index):
+        if self.cache is None:
+            return Image.open(self.ims[index]), Image.open(self.labels[index])
+        if self.cache["filled"][index]:
+            return self.cache["images"][index].numpy(), self.cache["labels"][index].numpy()
+        image, label = self._decode(index)
+        if image.shape == self.cache["images"].shape[1:] and label.shape == self.cache["labels"].shape[1:]:
+            self.cache["images"][index] = torch.from_numpy(image)
+            self.cache["labels"][index] = torch.from_numpy(label)
+            self.cache["filled"][index] = True
+        return image, label
+
+    def __getitem__(self, index):
+        image, label = self._load(index)
+        image = self.transform(image).float()
+        label = torch.from_numpy(np.asarray(label, dtype=np.int32)).long()
+        if self.device.type != 'cpu':
+            image, label = image.to(self.device), label.to(self.device)
 
         return image, label
 
     def __len__(self):
-        return len(self.ims)
\ No newline at end of file
+        return len(self.ims)
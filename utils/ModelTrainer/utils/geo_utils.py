@@ -1,4 +1,9 @@
 import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
 import cv2
 import numpy as np
 from osgeo import gdal
@@ -7,23 +12,493 @@ from concurrent.futures import ThreadPoolExecutor
 
 gdal.UseExceptions()
 
+# GDAL数据集句柄不是线程安全的，按(绝对路径, 修改时间, 线程)缓存只读句柄，
+# 按最近使用排序，超过_intMaxDatasetHandles个时关闭最久未使用的句柄
+_dictDatasetHandles = OrderedDict()
+_lockDatasetHandles = threading.Lock()
+_intMaxDatasetHandles = 64
+
+
+def _openDataset(strPath):
+    strPath = os.path.abspath(strPath)
+    intMtime = os.stat(strPath).st_mtime_ns
+    tupleKey = (strPath, intMtime, threading.get_ident())
+    with _lockDatasetHandles:
+        dataset = _dictDatasetHandles.get(tupleKey)
+        if dataset is not None:
+            _dictDatasetHandles.move_to_end(tupleKey)
+    if dataset is None:
+        dataset = gdal.Open(strPath)
+        with _lockDatasetHandles:
+            # 文件被覆盖后所有线程的旧句柄作废，不再读到旧像素
+            for tupleOldKey in [k for k in _dictDatasetHandles if k[0] == strPath and k[1] != intMtime]:
+                del _dictDatasetHandles[tupleOldKey]
+            _dictDatasetHandles[tupleKey] = dataset
+            while len(_dictDatasetHandles) > _intMaxDatasetHandles:
+                _dictDatasetHandles.popitem(last=False)
+    return dataset
+
+
+def _releaseDatasets(strPath):
+    """释放所有线程缓存的该文件句柄，覆盖或替换文件前调用（Windows上打开的文件不能被替换）"""
+    strPath = os.path.abspath(strPath)
+    with _lockDatasetHandles:
+        for tupleKey in [k for k in _dictDatasetHandles if k[0] == strPath]:
+            del _dictDatasetHandles[tupleKey]
+
+
+def _toHWC(npData):
+    # GDAL读出的数据为CHW或HW，统一转换为HWC
+    if len(npData.shape) == 2:
+        return np.expand_dims(npData, axis=2)
+    return np.moveaxis(npData, 0, -1)
+
+
+def _normalizeToUint8(npData, dblMin, dblMax):
+    # 将NaN和-inf替换为0后按全局最值线性拉伸到UINT8
+    npData = np.where(np.isnan(npData) | np.isneginf(npData), 0, npData)
+    return ((npData - dblMin) / (dblMax - dblMin) * 255).astype(np.uint8)
+
+
+def _normalizeBandsToUint8(npData, npMin, npScale, listNoData):
+    # 按波段最值线性拉伸到UINT8，只在float32上原地运算；NaN、inf与nodata像素置0
+    npOut = npData.astype(np.float32)
+    npInvalid = ~np.isfinite(npOut)
+    for i, dblNoData in enumerate(listNoData):
+        if dblNoData is not None:
+            npInvalid[:, :, i] |= npData[:, :, i] == dblNoData
+    npOut -= npMin
+    npOut *= npScale
+    np.clip(npOut, 0, 255, out=npOut)
+    npOut[npInvalid] = 0
+    return npOut.astype(np.uint8)
+
+
+_dictGdalDataTypes = {np.dtype(np.uint8): gdal.GDT_Byte, np.dtype(np.uint16): gdal.GDT_UInt16,
+                      np.dtype(np.int16): gdal.GDT_Int16, np.dtype(np.uint32): gdal.GDT_UInt32,
+                      np.dtype(np.int32): gdal.GDT_Int32, np.dtype(np.float64): gdal.GDT_Float64}
+
+
+def _gdalDataType(npDtype):
+    # 保持原始数据类型写出，其余类型按Float32写出
+    return _dictGdalDataTypes.get(np.dtype(npDtype), gdal.GDT_Float32)
+
+
+def _writeInterleaved(outDataset, npImage, intXOff=0, intYOff=0):
+    # HWC数据以CHW视图一次写入所有波段，GDAL按步长读取，不逐波段复制
+    if len(npImage.shape) == 2:
+        npImage = np.expand_dims(npImage, axis=2)
+    outDataset.WriteArray(np.moveaxis(npImage, 2, 0), intXOff, intYOff)
+
+
+def _createCopyCOG(srcDataset, strPath, strCompress='DEFLATE'):
+    """将数据集复制为云优化GeoTIFF：512瓦片、多线程压缩、内置金字塔"""
+    listOptions = [f'COMPRESS={strCompress}', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+    isPredictor = strCompress in ['DEFLATE', 'ZSTD', 'LZW']
+    driver = gdal.GetDriverByName('COG')
+    if driver is not None:
+        listOptions += ['BLOCKSIZE=512', 'RESAMPLING=AVERAGE'] + ['PREDICTOR=YES'] * isPredictor
+        outDataset = driver.CreateCopy(strPath, srcDataset, options=listOptions)
+        outDataset = None
+        return
+
+    # GDAL 3.1以前没有COG驱动：先在源数据集上建金字塔，再按相同布局复制为瓦片化GTiff
+    listLevels = []
+    intSize = max(srcDataset.RasterXSize, srcDataset.RasterYSize)
+    while intSize > 512:
+        listLevels.append(2 ** (len(listLevels) + 1))
+        intSize //= 2
+    if listLevels:
+        srcDataset.BuildOverviews('AVERAGE', listLevels)
+    if isPredictor:
+        isFloat = srcDataset.GetRasterBand(1).DataType in [gdal.GDT_Float32, gdal.GDT_Float64]
+        listOptions.append('PREDICTOR=3' if isFloat else 'PREDICTOR=2')
+    listOptions += ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COPY_SRC_OVERVIEWS=YES']
+    outDataset = gdal.GetDriverByName('GTiff').CreateCopy(strPath, srcDataset, options=listOptions)
+    outDataset = None
+
+
+def _scaleToUint8(npData, dblLower, dblUpper):
+    npClipped = np.clip(npData, dblLower, dblUpper)
+    return ((npClipped - dblLower) / (dblUpper - dblLower) * 255).astype(np.uint8)
+
+
+def _percentileFromHistogram(npHist, dblPercentile):
+    # 与np.percentile的线性插值结果一致：在累计直方图中定位相邻两个次序统计量后插值
+    npCumsum = np.cumsum(npHist)
+    dblRank = dblPercentile / 100 * (npCumsum[-1] - 1)
+    intLowRank = int(np.floor(dblRank))
+    intHighRank = min(intLowRank + 1, int(npCumsum[-1]) - 1)
+    intLowValue = np.searchsorted(npCumsum, intLowRank, side='right')
+    intHighValue = np.searchsorted(npCumsum, intHighRank, side='right')
+    return intLowValue + (dblRank - intLowRank) * (intHighValue - intLowValue)
+
+
+class PercentileStretcher:
+    """截断线性拉伸引擎，可逐窗口累计统计量和逐窗口拉伸
+
+    8/16位整数影像用一次bincount得到各波段直方图并求出精确百分位，拉伸通过查找表完成；
+    浮点影像按intSampleStep步长抽样估计百分位，拉伸使用float32原地运算。
+    3波段影像逐波段拉伸，单波段拉伸后复制为3波段，其余波段数整体拉伸。
+    listNoData给出各波段的nodata值，这些像素不参与统计，拉伸后置0。
+    """
+
+    def __init__(self, dblPercentile=2, intSampleStep=1, listNoData=None):
+        self.dblPercentile = dblPercentile
+        self.intSampleStep = intSampleStep
+        self.listNoData = listNoData or []
+        self.npDtype = None
+        self.intBands = None
+        self.npHist = None  # [波段, 灰度级]
+        self.listSamples = []
+        self.listBounds = None
+        self.npLut = None
+
+    def _isHistogram(self):
+        return np.issubdtype(self.npDtype, np.integer) and self.npDtype.itemsize <= 2
+
+    def _levelIndex(self, npWindow):
+        # 将整数灰度平移为从0开始的直方图下标
+        intMin = int(np.iinfo(self.npDtype).min)
+        if intMin == 0:
+            return npWindow
+        return npWindow.astype(np.int32) - intMin
+
+    def accumulate(self, npWindow):
+        if len(npWindow.shape) == 2:
+            npWindow = np.expand_dims(npWindow, axis=2)
+        if self.npDtype is None:
+            self.npDtype = npWindow.dtype
+            self.intBands = npWindow.shape[2]
+        self.listBounds = None
+        self.npLut = None
+
+        if self._isHistogram():
+            # 给每个波段的灰度加上偏移后一次bincount，同时得到所有波段的直方图
+            intLevels = 1 << (8 * self.npDtype.itemsize)
+            npIndex = self._levelIndex(npWindow).reshape(-1, self.intBands).astype(np.int32)
+            npIndex += np.arange(self.intBands, dtype=np.int32) * intLevels
+            npHist = np.bincount(npIndex.ravel(), minlength=self.intBands * intLevels)
+            npHist = npHist.reshape(self.intBands, intLevels)
+            self.npHist = npHist if self.npHist is None else self.npHist + npHist
+        else:
+            npSample = npWindow[::self.intSampleStep, ::self.intSampleStep]
+            self.listSamples.append(np.ascontiguousarray(npSample).reshape(-1, self.intBands))
+
+    def getBounds(self):
+        """返回每个拉伸通道的(下界, 上界)，3波段时为3组，否则为1组"""
+        if self.listBounds is not None:
+            return self.listBounds
+
+        isPerBand = self.intBands == 3
+        listPercentiles = [self.dblPercentile, 100 - self.dblPercentile]
+        if self._isHistogram():
+            intMin = int(np.iinfo(self.npDtype).min)
+            npHists = self.npHist.copy()
+            for i, dblNoData in enumerate(self.listNoData):
+                if dblNoData is not None and np.iinfo(self.npDtype).min <= dblNoData <= np.iinfo(self.npDtype).max:
+                    npHists[i, int(dblNoData) - intMin] = 0
+            npHists = npHists if isPerBand else npHists.sum(axis=0, keepdims=True)
+            self.listBounds = [tuple(_percentileFromHistogram(npHist, dbl) + intMin for dbl in listPercentiles)
+                               for npHist in npHists]
+        else:
+            npSamples = np.concatenate(self.listSamples)
+            funcPercentile = np.percentile
+            if any(dbl is not None for dbl in self.listNoData) or not np.isfinite(npSamples).all():
+                # nodata与非有限值不参与统计
+                npSamples = npSamples.astype(np.float64)
+                npSamples[~np.isfinite(npSamples)] = np.nan
+                for i, dblNoData in enumerate(self.listNoData):
+                    if dblNoData is not None:
+                        npSamples[npSamples[:, i] == dblNoData, i] = np.nan
+                funcPercentile = np.nanpercentile
+            if isPerBand:
+                npBounds = funcPercentile(npSamples, listPercentiles, axis=0)
+                self.listBounds = [tuple(npBounds[:, i]) for i in range(3)]
+            else:
+                self.listBounds = [tuple(funcPercentile(npSamples, listPercentiles))]
+        return self.listBounds
+
+    def apply(self, npWindow):
+        if len(npWindow.shape) == 2:
+            npWindow = np.expand_dims(npWindow, axis=2)
+        listBounds = self.getBounds()
+
+        if self._isHistogram():
+            if self.npLut is None:
+                intLevels = 1 << (8 * self.npDtype.itemsize)
+                intMin = int(np.iinfo(self.npDtype).min)
+                npLevels = np.arange(intLevels) + intMin
+                self.npLut = np.stack([_scaleToUint8(npLevels, dblLower, dblUpper) if dblUpper > dblLower
+                                       else np.zeros(intLevels, dtype=np.uint8)
+                                       for dblLower, dblUpper in listBounds])
+            npIndex = self._levelIndex(npWindow)
+            if len(listBounds) == 3:
+                npOut = np.empty(npWindow.shape, dtype=np.uint8)
+                for i in range(3):
+                    np.take(self.npLut[i], npIndex[:, :, i], out=npOut[:, :, i])
+            else:
+                npOut = np.take(self.npLut[0], npIndex)
+        else:
+            npOut = npWindow.astype(np.float32)
+            listChannels = [npOut[:, :, i] for i in range(3)] if len(listBounds) == 3 else [npOut]
+            for npChannel, (dblLower, dblUpper) in zip(listChannels, listBounds):
+                np.nan_to_num(npChannel, copy=False, nan=dblLower)
+                np.clip(npChannel, dblLower, dblUpper, out=npChannel)
+                npChannel -= dblLower
+                npChannel *= 255 / (dblUpper - dblLower) if dblUpper > dblLower else 0
+            npOut = npOut.astype(np.uint8)
+
+        for i, dblNoData in enumerate(self.listNoData):
+            if dblNoData is not None:
+                npOut[:, :, i][npWindow[:, :, i] == dblNoData] = 0
+        if npOut.shape[2] == 1:
+            npOut = np.repeat(npOut, 3, axis=2)
+        return npOut
+
+
 class ImageData:
-    def __init__(self, strImageName, npImageData, tupleOriginalShape, prj=None, geoTransform=None, isGdalRead=False):
+    def __init__(self, strImageName, npImageData, tupleOriginalShape, prj=None, geoTransform=None, isGdalRead=False,
+                 strSourcePath=None, listWindowOps=None, listNoData=None):
         self.strImageName = strImageName
-        self.npImageData = npImageData
+        self._npImageData = npImageData
         self.tupleOriginalShape = tupleOriginalShape
         self.prj = prj  # 投影信息
         self.geoTransform = geoTransform  # 地理变换矩阵
         self.isGdalRead = isGdalRead  # 标记图像是否通过GDAL读取
+        self.strSourcePath = strSourcePath  # 惰性读取的源文件路径，npImageData为None时按窗口从该文件读取
+        self.listWindowOps = listWindowOps or []  # 每个窗口读出后依次施加的处理函数
+        self.listNoData = listNoData  # 保持原始数据类型读取时各波段的nodata值
+
+    @property
+    def isLazy(self):
+        return self._npImageData is None and self.strSourcePath is not None
+
+    @property
+    def npImageData(self):
+        # 惰性影像只有在访问整幅数据时才完整读入内存，逐窗口处理后写入预分配的数组
+        if self.isLazy:
+            npProbe = self.probeWindow()
+            npImageData = np.empty(tuple(self.tupleOriginalShape) + npProbe.shape[2:], dtype=npProbe.dtype)
+            for intXOff, intYOff, intWidth, intHeight in self.iterWindows():
+                npImageData[intYOff:intYOff + intHeight, intXOff:intXOff + intWidth] = \
+                    self.readWindow(intXOff, intYOff, intWidth, intHeight)
+            self._npImageData = npImageData
+        return self._npImageData
+
+    @npImageData.setter
+    def npImageData(self, npImageData):
+        self._npImageData = npImageData
+
+    def readWindow(self, intXOff, intYOff, intWidth, intHeight, intBufWidth=None, intBufHeight=None):
+        """读取窗口数据(HWC)，指定缓冲区大小时由GDAL降采样读取（优先使用金字塔）"""
+        if self._npImageData is not None:
+            npWindow = self._npImageData[intYOff:intYOff + intHeight, intXOff:intXOff + intWidth]
+            if intBufWidth is not None and intBufHeight is not None:
+                npWindow = npWindow[::max(1, intHeight // intBufHeight), ::max(1, intWidth // intBufWidth)]
+            return npWindow
+
+        dataset = _openDataset(self.strSourcePath)
+        npWindow = _toHWC(dataset.ReadAsArray(intXOff, intYOff, intWidth, intHeight,
+                                              buf_xsize=intBufWidth, buf_ysize=intBufHeight))
+        for funcOp in self.listWindowOps:
+            npWindow = funcOp(npWindow)
+        return npWindow
+
+    def getBlockSize(self):
+        if not self.isLazy:
+            return 1, 1
+        return _openDataset(self.strSourcePath).GetRasterBand(1).GetBlockSize()
+
+    def iterWindows(self, intWindowSize=2048):
+        """按数据块对齐遍历影像，返回(intXOff, intYOff, intWidth, intHeight)，窗口像素数约为intWindowSize²"""
+        intHeight, intWidth = self.tupleOriginalShape
+        intBlockX, intBlockY = self.getBlockSize()
+        intStepX = min(intWidth, max(intBlockX, intWindowSize // intBlockX * intBlockX))
+        intStepY = max(intBlockY, intWindowSize * intWindowSize // intStepX // intBlockY * intBlockY)
+        for intYOff in range(0, intHeight, intStepY):
+            for intXOff in range(0, intWidth, intStepX):
+                yield intXOff, intYOff, min(intStepX, intWidth - intXOff), min(intStepY, intHeight - intYOff)
+
+    def probeWindow(self):
+        # 读取1×1窗口以获知处理后的波段数和数据类型
+        return self.readWindow(0, 0, 1, 1)
+
+    def close(self):
+        if self.strSourcePath is not None:
+            _releaseDatasets(self.strSourcePath)
 
 
 class ProcessedImageData(ImageData):
     def __init__(self, strImageName, npImageData, tupleOriginalShape, processingStep=None, prj=None,
-                 geoTransform=None, isGdalRead=False):
-        super().__init__(strImageName, npImageData, tupleOriginalShape, prj, geoTransform, isGdalRead)
+                 geoTransform=None, isGdalRead=False, strSourcePath=None, listWindowOps=None, listNoData=None):
+        super().__init__(strImageName, npImageData, tupleOriginalShape, prj, geoTransform, isGdalRead,
+                         strSourcePath, listWindowOps, listNoData)
         self.processingStep = processingStep  # 存储处理步骤的信息
 
 
+def _parseCropKey(strItem):
+    # 裁剪结果键名形如001002003，依次为组号、行号、列号
+    try:
+        return int(strItem[:3]), int(strItem[3:6]), int(strItem[6:9])
+    except ValueError:
+        raise ValueError(f"Invalid crop key format: {strItem}")
+
+
+class TileGrid:
+    """按(组号, 行, 列)索引的瓦片注册表，每组对应一幅源影像，行列号从1开始"""
+
+    def __init__(self, intWidth=512, intHeight=512, intStep=256, tupleOrigin=(0, 0)):
+        self.intWidth = intWidth
+        self.intHeight = intHeight
+        self.intStep = intStep
+        self.tupleOrigin = tupleOrigin  # 第一块瓦片左上角的像素坐标(x, y)
+        self.dictGroups = {}  # 组号 -> [影像名, 瓦片数组]
+
+    @classmethod
+    def fromCrops(cls, dictCrops, intWidth=512, intHeight=512, intStep=256):
+        """由键名形如001002003的裁剪结果字典一次性建立注册表"""
+        listIndexed = [(_parseCropKey(strKey), objCrop) for strKey, objCrop in dictCrops.items()]
+        dictShapes = {}
+        for (intGroup, intRow, intCol), _ in listIndexed:
+            intRows, intCols = dictShapes.get(intGroup, (0, 0))
+            dictShapes[intGroup] = (max(intRows, intRow), max(intCols, intCol))
+
+        objGrid = cls(intWidth, intHeight, intStep)
+        for intGroup, tupleGridShape in dictShapes.items():
+            objGrid.dictGroups[intGroup] = [None, np.empty(tupleGridShape, dtype=object)]
+        for (intGroup, intRow, intCol), objCrop in listIndexed:
+            objGrid.dictGroups[intGroup][1][intRow - 1, intCol - 1] = objCrop
+        return objGrid
+
+    def addGroup(self, intGroup, strImageName, tupleShape):
+        intRows = -(-tupleShape[0] // self.intStep)
+        intCols = -(-tupleShape[1] // self.intStep)
+        self.dictGroups[intGroup] = [strImageName, np.empty((intRows, intCols), dtype=object)]
+
+    def setTile(self, intGroup, intRow, intCol, objTile):
+        self.dictGroups[intGroup][1][intRow - 1, intCol - 1] = objTile
+
+    def getTile(self, intGroup, intRow, intCol):
+        return self.dictGroups[intGroup][1][intRow - 1, intCol - 1]
+
+    def getGroupName(self, intGroup):
+        return self.dictGroups[intGroup][0]
+
+    def getGridShape(self, intGroup):
+        return self.dictGroups[intGroup][1].shape
+
+    def getTileOffset(self, intRow, intCol):
+        # 瓦片左上角的像素坐标(x, y)
+        return (self.tupleOrigin[0] + (intCol - 1) * self.intStep,
+                self.tupleOrigin[1] + (intRow - 1) * self.intStep)
+
+    def iterTiles(self, intGroup):
+        """按行优先顺序遍历一组中的瓦片，返回(intRow, intCol, objTile)"""
+        npTiles = self.dictGroups[intGroup][1]
+        for (intRowIdx, intColIdx), objTile in np.ndenumerate(npTiles):
+            if objTile is not None:
+                yield intRowIdx + 1, intColIdx + 1, objTile
+
+
+class StitchAccumulator:
+    """拼接累加器：strOutPath不为空时结果逐窗口写入分块GeoTIFF，isAverage为True时重叠区域取平均"""
+
+    def __init__(self, tupleShape, strOutPath=None, prj=None, geoTransform=None, isAverage=False):
+        self.intHeight, self.intWidth = tupleShape
+        self.strOutPath = strOutPath
+        self.prj = prj
+        self.geoTransform = geoTransform
+        self.isAverage = isAverage
+        self.npResult = None  # 内存模式下的拼接结果
+        self.outDataset = None  # 磁盘模式下的输出数据集
+        self.npScore = None  # float16累加值
+        self.npWeight = None  # float16权重
+        self.npDtype = None
+
+    def _allocate(self, intBands, npDtype):
+        self.npDtype = np.dtype(npDtype)
+        tupleShape = (self.intHeight, self.intWidth)
+        if self.strOutPath is None:
+            self.npResult = np.zeros(tupleShape + (intBands,), dtype=self.npDtype)
+        else:
+            driver = gdal.GetDriverByName("GTiff")
+            dataType = _gdalDataType(self.npDtype)
+            self.outDataset = driver.Create(self.strOutPath, self.intWidth, self.intHeight, intBands, dataType,
+                                            ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER'])
+            if self.prj is not None:
+                self.outDataset.SetProjection(self.prj)
+            if self.geoTransform is not None:
+                self.outDataset.SetGeoTransform(self.geoTransform)
+
+        if self.isAverage:
+            if self.strOutPath is None:
+                self.npScore = np.zeros(tupleShape + (intBands,), dtype=np.float16)
+                self.npWeight = np.zeros(tupleShape, dtype=np.float16)
+            else:
+                # 累加器放在磁盘上的内存映射文件中，页缓存按需换入换出
+                self.npScore = np.lib.format.open_memmap(self.strOutPath + '.score.npy', mode='w+',
+                                                         dtype=np.float16, shape=tupleShape + (intBands,))
+                self.npWeight = np.lib.format.open_memmap(self.strOutPath + '.weight.npy', mode='w+',
+                                                          dtype=np.float16, shape=tupleShape)
+
+    def _write(self, npWindow, intXOff, intYOff):
+        if self.outDataset is None:
+            self.npResult[intYOff:intYOff + npWindow.shape[0], intXOff:intXOff + npWindow.shape[1]] = npWindow
+        else:
+            _writeInterleaved(self.outDataset, npWindow, intXOff, intYOff)
+
+    def addTile(self, npTile, intXOff, intYOff, npTileWeight=None):
+        """将瓦片放到(intXOff, intYOff)处，超出影像范围的部分被裁掉；npTileWeight为可选的逐像素权重"""
+        if len(npTile.shape) == 2:
+            npTile = np.expand_dims(npTile, axis=2)
+        if self.npDtype is None:
+            self._allocate(npTile.shape[2], npTile.dtype)
+
+        intHEnd = min(intYOff + npTile.shape[0], self.intHeight)
+        intWEnd = min(intXOff + npTile.shape[1], self.intWidth)
+        if intHEnd <= intYOff or intWEnd <= intXOff:
+            return
+        npTile = npTile[:intHEnd - intYOff, :intWEnd - intXOff]
+
+        if not self.isAverage:
+            self._write(npTile, intXOff, intYOff)
+            return
+
+        if npTileWeight is None:
+            self.npScore[intYOff:intHEnd, intXOff:intWEnd] += npTile.astype(np.float16)
+            self.npWeight[intYOff:intHEnd, intXOff:intWEnd] += np.float16(1)
+        else:
+            npTileWeight = npTileWeight[:intHEnd - intYOff, :intWEnd - intXOff].astype(np.float16)
+            self.npScore[intYOff:intHEnd, intXOff:intWEnd] += npTile.astype(np.float16) * npTileWeight[:, :, None]
+            self.npWeight[intYOff:intHEnd, intXOff:intWEnd] += npTileWeight
+
+    def close(self, intRowsPerWindow=512):
+        """完成拼接，内存模式返回结果数组，磁盘模式返回None"""
+        if self.npDtype is None:
+            self._allocate(3, np.uint8)
+
+        if self.isAverage:
+            # 按行条带归一化累加值，避免生成整幅的浮点临时数组
+            for intYOff in range(0, self.intHeight, intRowsPerWindow):
+                npScore = self.npScore[intYOff:intYOff + intRowsPerWindow].astype(np.float32)
+                npWeight = self.npWeight[intYOff:intYOff + intRowsPerWindow].astype(np.float32)
+                npWindow = npScore / np.maximum(npWeight, 1e-6)[:, :, None]
+                if np.issubdtype(self.npDtype, np.integer):
+                    npWindow = np.rint(npWindow)
+                self._write(npWindow.astype(self.npDtype), 0, intYOff)
+
+            if self.strOutPath is not None:
+                self.npScore = self.npWeight = None
+                os.remove(self.strOutPath + '.score.npy')
+                os.remove(self.strOutPath + '.weight.npy')
+
+        if self.outDataset is not None:
+            self.outDataset.FlushCache()
+            self.outDataset = None
+        return self.npResult
+
+
 class ImageManager:
     def __init__(self):
         self.dictImages = {}
@@ -32,6 +507,13 @@ class ImageManager:
         self.dictConvertedImages = {}
         self.dictGeoReferencedImages = {}  # 新增字典用于存储带有地理信息的图像
         self.dictAppendedImages = {}  # 新增字典用于存储追加的图像
+        self.objTileGrid = None  # 最近一次cropImg生成的瓦片注册表
+
+    def close(self):
+        """释放所有惰性影像的数据集句柄，长时间运行的服务在处理完请求后调用"""
+        for dictImages in (self.dictImages, self.dictAppendedImages, self.dictConvertedImages):
+            for imageData in dictImages.values():
+                imageData.close()
 
     def appendImagesFrom(self, sourceDictName):
         if not hasattr(self, sourceDictName):
@@ -47,246 +529,277 @@ class ImageManager:
 
     # 私有排序器
     def _sortKey(self, strItem):
-        try:
-            return int(strItem[:3]), int(strItem[3:6]), int(strItem[6:9])
-        except ValueError:
-            raise ValueError(f"Invalid crop key format: {strItem}")
+        return _parseCropKey(strItem)
 
-    # 读取图片（公共方法）
-    def readImg(self, strFilePath, append=False):
+    # 读取图片（公共方法），lazy=True时GeoTIFF只保留数据集句柄，按窗口读取
+    # strNormalize为GeoTIFF的归一化方式：'global'按全局最值转为UINT8，'band'按GDAL波段统计量逐波段转为UINT8，
+    # 'native'保持原始数据类型和nodata值
+    def readImg(self, strFilePath, append=False, lazy=False, strNormalize='global'):
         if os.path.isfile(strFilePath):
-            self._addImageToDict(strFilePath, append)
+            self._addImageToDict(strFilePath, append, lazy, strNormalize)
         elif os.path.isdir(strFilePath):
             for strFilename in os.listdir(strFilePath):
                 strFilePathFull = os.path.join(strFilePath, strFilename)
                 if os.path.isfile(strFilePathFull):
-                    self._addImageToDict(strFilePathFull, append)
+                    self._addImageToDict(strFilePathFull, append, lazy, strNormalize)
 
     # 添加图片到字典（私有方法）
-    def _addImageToDict(self, strPath, append=False):
+    def _addImageToDict(self, strPath, append=False, lazy=False, strNormalize='global'):
         strImageName = os.path.basename(strPath).split('.')[0]
         fileExtension = strPath.lower().split('.')[-1]
 
         if fileExtension == 'tif' or fileExtension == 'tiff':
-            dataset = gdal.Open(strPath)
-            if dataset is None:
-                print(f"Failed to open image: {strPath}")
+            imageData = self._openLazyImage(strPath, strImageName, strNormalize)
+            if imageData is None:
                 return
-
-            npImageData = dataset.ReadAsArray()
-            prj = dataset.GetProjection()
-            geoTransform = dataset.GetGeoTransform()
-            dataset = None  # Close the dataset
-            isGdalRead = True
-
-            # 处理NaN值，并转换为UINT8
-            npImageData = np.where(np.isnan(npImageData) | np.isneginf(npImageData), 0, npImageData)  # 将NaN和-inf替换为0
-            min_val = np.min(npImageData)
-            max_val = np.max(npImageData)
-            npImageData = ((npImageData - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-
-            if len(npImageData.shape) == 2:
-                npImageData = np.expand_dims(npImageData, axis=2)
+            if not lazy:
+                # 访问npImageData即逐窗口归一化后写入预分配数组，不产生整幅的浮点中间结果
+                _ = imageData.npImageData
+                imageData.close()
+                imageData.strSourcePath = None
+                imageData.listWindowOps = []
+            if append:
+                self.dictAppendedImages[strImageName] = imageData
             else:
-                npImageData = np.moveaxis(npImageData, 0, -1)
-
-        else:
-            npImageData = cv2.imread(strPath)
-            prj = None
-            geoTransform = None
-            isGdalRead = False
+                self.dictImages[strImageName] = imageData
+            return
 
+        npImageData = cv2.imread(strPath)
         if npImageData is not None:
-            imageData = ImageData(strImageName, npImageData, npImageData.shape[:2], prj, geoTransform, isGdalRead)
+            imageData = ImageData(strImageName, npImageData, npImageData.shape[:2], None, None, False)
             if append:
                 self.dictAppendedImages[strImageName] = imageData
             else:
                 self.dictImages[strImageName] = imageData
 
-    # 保存图片（公共方法）
-    def saveImg(self, strSavePath, dictImages=None, strOutFormat='.jpg', formEE=False):
+    # 以惰性方式打开GeoTIFF（私有方法）
+    def _openLazyImage(self, strPath, strImageName, strNormalize='global'):
+        if strNormalize not in ['global', 'band', 'native']:
+            print(f"Unknown normalize mode: {strNormalize}")
+            return None
+        dataset = _openDataset(strPath)
+        if dataset is None:
+            print(f"Failed to open image: {strPath}")
+            return None
+
+        imageData = ImageData(strImageName, None, (dataset.RasterYSize, dataset.RasterXSize),
+                              dataset.GetProjection(), dataset.GetGeoTransform(), True, strPath)
+        listNoData = [dataset.GetRasterBand(i + 1).GetNoDataValue() for i in range(dataset.RasterCount)]
+
+        if strNormalize == 'native':
+            imageData.listNoData = listNoData
+            return imageData
+
+        if strNormalize == 'band':
+            # 近似模式下GDAL利用金字塔或抽样计算波段最值，并自动排除nodata
+            npMin = np.zeros(dataset.RasterCount, dtype=np.float32)
+            npMax = np.zeros(dataset.RasterCount, dtype=np.float32)
+            for i in range(dataset.RasterCount):
+                try:
+                    npMin[i], npMax[i] = dataset.GetRasterBand(i + 1).ComputeRasterMinMax(True)
+                except (RuntimeError, TypeError):
+                    print(f"Band {i + 1} of {strPath} has no valid pixels")
+            npRange = npMax - npMin
+            npScale = np.divide(255, npRange, out=np.zeros_like(npRange), where=npRange > 0)
+            imageData.listWindowOps = [partial(_normalizeBandsToUint8, npMin=npMin, npScale=npScale,
+                                               listNoData=listNoData)]
+            return imageData
+
+        # 逐窗口统计全局最值，与整幅读取时的UINT8归一化结果一致
+        dblMin, dblMax = np.inf, -np.inf
+        for intXOff, intYOff, intWidth, intHeight in imageData.iterWindows():
+            npWindow = imageData.readWindow(intXOff, intYOff, intWidth, intHeight)
+            npWindow = np.where(np.isnan(npWindow) | np.isneginf(npWindow), 0, npWindow)
+            dblMin = min(dblMin, np.min(npWindow))
+            dblMax = max(dblMax, np.max(npWindow))
+        imageData.listWindowOps = [partial(_normalizeToUint8, dblMin=dblMin, dblMax=dblMax)]
+        return imageData
+
+    # 保存图片（公共方法），多线程并行写出（cv2与GDAL编码时释放GIL），结束后打印吞吐量
+    # isCOG=True时GeoTIFF按云优化格式写出（瓦片化、strCompress压缩、内置金字塔）
+    # intPngCompression为PNG压缩级别(0-9)，None时使用OpenCV默认值；intWorkers为写出线程数
+    def saveImg(self, strSavePath, dictImages=None, strOutFormat='.jpg', formEE=False, strNameSuffix='', isCOG=False,
+                strCompress='DEFLATE', intPngCompression=None, intWorkers=None):
         if not os.path.exists(strSavePath):
             os.makedirs(strSavePath)
 
         if dictImages is None:
             dictImages = self.dictImages
 
-        for strKey, objValue in dictImages.items():
-            if isinstance(objValue, (ImageData, ProcessedImageData)):
-                npImage = objValue.npImageData.copy()
-                strImageName = objValue.strImageName
-                prj = objValue.prj
-                geoTransform = objValue.geoTransform
-                isGdalRead = objValue.isGdalRead
-            else:
-                npImage = objValue
-                strImageName = strKey
-                prj = None
-                geoTransform = None
-                isGdalRead = False
-
-            savePath = os.path.join(strSavePath, f"{strImageName}{strOutFormat}")
-
-            if isGdalRead and len(npImage.shape) == 3 and npImage.shape[2] == 3:
-                # 将RGB图像转换为BGR格式(通过GDAL读取的数据无法被OpenCV正常使用，颜色会有问题)
-                if not formEE:
-                    npImage = cv2.cvtColor(npImage, cv2.COLOR_RGB2BGR)
-                else:
-                    npImage = npImage
-
-
-            if strOutFormat.lower() in ['.tif', '.tiff']:
-                driver = gdal.GetDriverByName("GTiff")
-                numBands = npImage.shape[2] if len(npImage.shape) == 3 else 1
-                dataType = gdal.GDT_Byte if npImage.dtype == np.uint8 else gdal.GDT_Float32
-                outDataset = driver.Create(savePath, npImage.shape[1], npImage.shape[0], numBands, dataType)
-                outDataset.SetProjection(prj)
-                outDataset.SetGeoTransform(geoTransform)
-                if numBands == 1:
-                    outBand = outDataset.GetRasterBand(1)
-                    outBand.WriteArray(npImage[:, :, 0] if len(npImage.shape) == 3 else npImage)
-                else:
-                    for i in range(numBands):
-                        outBand = outDataset.GetRasterBand(i + 1)
-                        outBand.WriteArray(npImage[:, :, i])
-                outDataset.FlushCache()
-                outDataset = None
-            else:
-                cv2.imwrite(savePath, npImage)
-            print(f"Saved image: {savePath}")
+        listParams = []
+        if strOutFormat.lower() == '.png' and intPngCompression is not None:
+            listParams = [cv2.IMWRITE_PNG_COMPRESSION, intPngCompression]
 
-    def savePredicted(self, strSavePath, dictImages=None, strOutFormat='.jpg', formEE=False):
-        if not os.path.exists(strSavePath):
-            os.makedirs(strSavePath)
+        def saveImage(strKey, objValue):
+            if isinstance(objValue, ImageData) and objValue.isLazy and strOutFormat.lower() in ['.tif', '.tiff']:
+                savePath = os.path.join(strSavePath, f"{objValue.strImageName}{strNameSuffix}{strOutFormat}")
+                self._saveLazyTif(savePath, objValue, formEE, isCOG, strCompress)
+                print(f"Saved image: {savePath}\n", end='')  # 多线程下整行一次写出，避免输出交错
+                return savePath
 
-        if dictImages is None:
-            dictImages = self.dictImages
-
-        for strKey, objValue in dictImages.items():
             if isinstance(objValue, (ImageData, ProcessedImageData)):
-                npImage = objValue.npImageData.copy()
-                strImageName = objValue.strImageName + '_ori'
+                npImage = objValue.npImageData
+                strImageName = objValue.strImageName + strNameSuffix
                 prj = objValue.prj
                 geoTransform = objValue.geoTransform
                 isGdalRead = objValue.isGdalRead
+                listNoData = objValue.listNoData or []
             else:
                 npImage = objValue
-                strImageName = strKey + '_ori'
+                strImageName = strKey + strNameSuffix
                 prj = None
                 geoTransform = None
                 isGdalRead = False
+                listNoData = []
 
             savePath = os.path.join(strSavePath, f"{strImageName}{strOutFormat}")
 
-            if isGdalRead and len(npImage.shape) == 3 and npImage.shape[2] == 3:
-                # 将RGB图像转换为BGR格式(通过GDAL读取的数据无法被OpenCV正常使用，颜色会有问题)
-                if not formEE:
-                    npImage = cv2.cvtColor(npImage, cv2.COLOR_RGB2BGR)
-                else:
-                    npImage = npImage
-
+            # 将RGB图像转换为BGR格式(通过GDAL读取的数据无法被OpenCV正常使用，颜色会有问题)
+            # 只有需要转换时才生成新数组，其余情况直接写出原数据
+            if isGdalRead and len(npImage.shape) == 3 and npImage.shape[2] == 3 and not formEE:
+                npImage = cv2.cvtColor(npImage, cv2.COLOR_RGB2BGR)
 
             if strOutFormat.lower() in ['.tif', '.tiff']:
-                driver = gdal.GetDriverByName("GTiff")
+                # COG只能由CreateCopy生成，先写入内存数据集
+                driver = gdal.GetDriverByName("MEM" if isCOG else "GTiff")
                 numBands = npImage.shape[2] if len(npImage.shape) == 3 else 1
-                dataType = gdal.GDT_Byte if npImage.dtype == np.uint8 else gdal.GDT_Float32
-                outDataset = driver.Create(savePath, npImage.shape[1], npImage.shape[0], numBands, dataType)
+                dataType = _gdalDataType(npImage.dtype)
+                outDataset = driver.Create('' if isCOG else savePath, npImage.shape[1], npImage.shape[0], numBands,
+                                           dataType)
                 outDataset.SetProjection(prj)
                 outDataset.SetGeoTransform(geoTransform)
-                if numBands == 1:
-                    outBand = outDataset.GetRasterBand(1)
-                    outBand.WriteArray(npImage[:, :, 0] if len(npImage.shape) == 3 else npImage)
-                else:
-                    for i in range(numBands):
-                        outBand = outDataset.GetRasterBand(i + 1)
-                        outBand.WriteArray(npImage[:, :, i])
+                for i, dblNoData in enumerate(listNoData[:numBands]):
+                    if dblNoData is not None:
+                        outDataset.GetRasterBand(i + 1).SetNoDataValue(dblNoData)
+                _writeInterleaved(outDataset, npImage)
+                if isCOG:
+                    _createCopyCOG(outDataset, savePath, strCompress)
                 outDataset.FlushCache()
                 outDataset = None
             else:
-                cv2.imwrite(savePath, npImage)
-            print(f"Saved image: {savePath}")
+                cv2.imwrite(savePath, npImage, listParams)
+            print(f"Saved image: {savePath}\n", end='')
+            return savePath
+
+        dblStart = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=intWorkers) as executor:
+            listPaths = list(executor.map(saveImage, dictImages.keys(), dictImages.values()))
+        dblElapsed = max(time.perf_counter() - dblStart, 1e-6)
+        dblMegabytes = sum(os.path.getsize(strPath) for strPath in listPaths if os.path.exists(strPath)) / 1024 ** 2
+        print(f"Saved {len(listPaths)} images ({dblMegabytes:.1f} MB) in {dblElapsed:.2f}s: "
+              f"{len(listPaths) / dblElapsed:.1f} images/s, {dblMegabytes / dblElapsed:.1f} MB/s")
 
-    # 影像裁剪（公共方法）
+    def savePredicted(self, strSavePath, dictImages=None, strOutFormat='.jpg', formEE=False):
+        self.saveImg(strSavePath, dictImages, strOutFormat, formEE, strNameSuffix='_ori')
+
+    # 按窗口写出惰性影像，内存占用只与窗口大小有关（私有方法）
+    def _saveLazyTif(self, savePath, objImageData, formEE, isCOG=False, strCompress='DEFLATE'):
+        intHeight, intWidth = objImageData.tupleOriginalShape
+        npProbe = objImageData.probeWindow()
+        numBands = npProbe.shape[2]
+        dataType = _gdalDataType(npProbe.dtype)
+        isSwapRB = objImageData.isGdalRead and numBands == 3 and not formEE
+
+        # 输出路径与源文件相同时先写临时文件，写完后再替换源文件
+        isOverwrite = os.path.abspath(savePath) == os.path.abspath(objImageData.strSourcePath)
+        strWritePath = savePath + '.tmp' if isOverwrite else savePath
+
+        # COG只能由CreateCopy生成，先逐窗口写入瓦片化的暂存文件
+        strStagePath = strWritePath + '.stage.tif' if isCOG else strWritePath
+        driver = gdal.GetDriverByName("GTiff")
+        outDataset = driver.Create(strStagePath, intWidth, intHeight, numBands, dataType,
+                                   options=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER'])
+        outDataset.SetProjection(objImageData.prj)
+        outDataset.SetGeoTransform(objImageData.geoTransform)
+        for i, dblNoData in enumerate((objImageData.listNoData or [])[:numBands]):
+            if dblNoData is not None:
+                outDataset.GetRasterBand(i + 1).SetNoDataValue(dblNoData)
+        for intXOff, intYOff, intWinWidth, intWinHeight in objImageData.iterWindows():
+            npWindow = objImageData.readWindow(intXOff, intYOff, intWinWidth, intWinHeight)
+            if isSwapRB:
+                npWindow = npWindow[:, :, ::-1]
+            _writeInterleaved(outDataset, npWindow, intXOff, intYOff)
+        outDataset.FlushCache()
+        if isCOG:
+            _createCopyCOG(outDataset, strWritePath, strCompress)
+            outDataset = None
+            driver.Delete(strStagePath)
+        outDataset = None
+
+        if isOverwrite:
+            objImageData.close()
+            os.replace(strWritePath, savePath)
+            # 源文件已被替换为处理结果，之后直接读取新文件
+            if not isSwapRB:
+                objImageData.listWindowOps = []
+
+    # 影像裁剪（公共方法），结果全部保存在dictCroppedImages中
     def cropImg(self, intWidth=512, intHeight=512, intStep=256, intStartGroup=1):
         self.dictCroppedImages.clear()  # 清空之前的裁剪结果
-        intGroup = intStartGroup
+        self.objTileGrid = TileGrid(intWidth, intHeight, intStep)
+        listImageNames = list(self.dictImages.keys())
+        for intGroup, intRow, intCol, objCrop in self.iterCrops(intWidth, intHeight, intStep, intStartGroup):
+            if intGroup not in self.objTileGrid.dictGroups:
+                self.objTileGrid.addGroup(intGroup, listImageNames[intGroup - intStartGroup], objCrop.tupleOriginalShape)
+            self.objTileGrid.setTile(intGroup, intRow, intCol, objCrop)
+            self.dictCroppedImages[objCrop.strImageName] = objCrop
+
+    # 逐块生成裁剪结果（公共方法），内存占用与瓦片数量无关
+    def iterCrops(self, intWidth=512, intHeight=512, intStep=256, intStartGroup=1, dictImages=None):
+        """按dictImages顺序为每幅影像分配组号，生成(intGroup, intRow, intCol, ProcessedImageData)，行列号从1开始"""
+        if dictImages is None:
+            dictImages = self.dictImages
 
-        def processImage(strImgName, objImageData):
-            tupleSize = objImageData.npImageData.shape[:2]
-            croppedImages = []
+        for intGroup, objImageData in enumerate(dictImages.values(), intStartGroup):
+            if objImageData.isLazy:
+                tupleSize = objImageData.tupleOriginalShape
+            else:
+                tupleSize = objImageData.npImageData.shape[:2]
 
-            intImgH = intImgW = 1
-            for intStartH in range(0, tupleSize[0], intStep):
+            for intImgH, intStartH in enumerate(range(0, tupleSize[0], intStep), 1):
                 intEndH = min(intStartH + intHeight, tupleSize[0])
-                intHPad = max(0, intHeight - (tupleSize[0] - intStartH))
 
-                for intStartW in range(0, tupleSize[1], intStep):
+                for intImgW, intStartW in enumerate(range(0, tupleSize[1], intStep), 1):
                     intEndW = min(intStartW + intWidth, tupleSize[1])
-                    intWPad = max(0, intWidth - (tupleSize[1] - intStartW))
 
-                    npCrop = objImageData.npImageData[intStartH:intEndH, intStartW:intEndW]
-
-                    if intHPad > 0 or intWPad > 0:
-                        npPaddedCrop = np.zeros((intHeight, intWidth, 3), dtype=np.uint8)
+                    # 内存影像的内部瓦片直接返回视图，只有越过边缘的瓦片才补零
+                    npCrop = objImageData.readWindow(intStartW, intStartH, intEndW - intStartW, intEndH - intStartH)
+                    if npCrop.shape[0] < intHeight or npCrop.shape[1] < intWidth:
+                        npPaddedCrop = np.zeros((intHeight, intWidth) + npCrop.shape[2:], dtype=npCrop.dtype)
                         npPaddedCrop[:npCrop.shape[0], :npCrop.shape[1]] = npCrop
                         npCrop = npPaddedCrop
 
                     strNameImg = f"{intGroup:03d}{intImgH:03d}{intImgW:03d}"
-                    croppedImages.append(
-                        ProcessedImageData(strNameImg, npCrop, objImageData.tupleOriginalShape, "cropped",
-                                           objImageData.prj, objImageData.geoTransform, objImageData.isGdalRead))
-                    intImgW += 1
-
-                intImgH += 1
-                intImgW = 1
-            return croppedImages
-
-        with ThreadPoolExecutor() as executor:
-            futures = {executor.submit(processImage, strImgName, objImageData): strImgName for
-                       strImgName, objImageData in self.dictImages.items()}
-            for future in futures:
-                croppedImages = future.result()
-                for imgData in croppedImages:
-                    self.dictCroppedImages[imgData.strImageName] = imgData
-
-        intGroup += 1
+                    yield intGroup, intImgH, intImgW, ProcessedImageData(
+                        strNameImg, npCrop, objImageData.tupleOriginalShape, "cropped",
+                        objImageData.prj, objImageData.geoTransform, objImageData.isGdalRead)
 
     # 影像拼接（公共方法）
-    def stitchImg(self, intWidth=512, intHeight=512, intStep=256):
+    def stitchImg(self, intWidth=512, intHeight=512, intStep=256, strOutDir=None, isAverage=False):
+        """strOutDir不为空时结果逐块写入该目录下的分块GeoTIFF（不在内存中保留整幅结果），isAverage为True时重叠区域取平均"""
         self.dictStitchedImages.clear()  # 清空之前的拼接结果
+        if strOutDir is not None and not os.path.exists(strOutDir):
+            os.makedirs(strOutDir)
 
-        def processImage(strImgName, objImageData):
-            intOriginalHeight, intOriginalWidth = objImageData.tupleOriginalShape
-            npStitchedImage = np.zeros((intOriginalHeight, intOriginalWidth, 3), dtype=np.uint8)
-
-            listCrops = [k for k in self.dictCroppedImages.keys()]
-            sortedCrops = sorted(listCrops, key=self._sortKey)
-
-            for strCropKey in sortedCrops:
-                _, intHIdx, intWIdx = self._sortKey(strCropKey)
-                intHStart = (intHIdx - 1) * intStep
-                intWStart = (intWIdx - 1) * intStep
-
-                intHEnd = min(intHStart + intHeight, intOriginalHeight)
-                intWEnd = min(intWStart + intWidth, intOriginalWidth)
-
-                npCrop = self.dictCroppedImages[strCropKey].npImageData
+        # dictCroppedImages可能已被替换（如预测结果），因此按当前键名一次性重建注册表
+        objGrid = TileGrid.fromCrops(self.dictCroppedImages, intWidth, intHeight, intStep)
+        dictImageGroups = self._matchTileGroups(objGrid)
 
-                actualHStart = max(0, intHStart)
-                actualWStart = max(0, intWStart)
-                actualHEnd = min(intOriginalHeight, intHEnd)
-                actualWEnd = min(intOriginalWidth, intWEnd)
-
-                cropHStart = actualHStart - intHStart
-                cropWStart = actualWStart - intWStart
-                cropHEnd = cropHStart + (actualHEnd - actualHStart)
-                cropWEnd = cropWStart + (actualWEnd - actualWStart)
+        def processImage(strImgName, objImageData):
+            strOutPath = None if strOutDir is None else os.path.join(strOutDir, f"{strImgName}.tif")
+            objAccumulator = StitchAccumulator(objImageData.tupleOriginalShape, strOutPath, objImageData.prj,
+                                               objImageData.geoTransform, isAverage)
 
-                npStitchedImage[actualHStart:actualHEnd, actualWStart:actualWEnd] = \
-                    npCrop[cropHStart:cropHEnd, cropWStart:cropWEnd]
+            intGroup = dictImageGroups.get(strImgName)
+            if intGroup is not None:
+                for intRow, intCol, objCrop in objGrid.iterTiles(intGroup):
+                    intXOff, intYOff = objGrid.getTileOffset(intRow, intCol)
+                    objAccumulator.addTile(objCrop.npImageData[:intHeight, :intWidth], intXOff, intYOff)
 
+            npStitchedImage = objAccumulator.close()
             return ProcessedImageData(strImgName, npStitchedImage, objImageData.tupleOriginalShape, "stitched",
-                                      objImageData.prj, objImageData.geoTransform, objImageData.isGdalRead)
+                                      objImageData.prj, objImageData.geoTransform, objImageData.isGdalRead,
+                                      strOutPath)
 
         with ThreadPoolExecutor() as executor:
             futures = {executor.submit(processImage, strImgName, objImageData): strImgName for
@@ -295,24 +808,46 @@ class ImageManager:
                 stitchedImage = future.result()
                 self.dictStitchedImages[stitchedImage.strImageName] = stitchedImage
 
+    # 确定每幅源影像对应的瓦片组号（私有方法）
+    def _matchTileGroups(self, objGrid):
+        listGroups = sorted(objGrid.dictGroups)
+        if self.objTileGrid is not None:
+            dictImageGroups = {self.objTileGrid.getGroupName(intGroup): intGroup for intGroup in listGroups
+                               if intGroup in self.objTileGrid.dictGroups}
+            if dictImageGroups:
+                return dictImageGroups
+        # 没有裁剪记录时按dictImages顺序依次对应组号
+        return dict(zip(self.dictImages.keys(), listGroups))
+
     # 图像转换为8位无符号整数（公共方法）
-    def truncatedLinearStretch(self, dblPercentile=2):
+    def truncatedLinearStretch(self, dblPercentile=2, intSampleStep=None):
+        """intSampleStep为浮点影像统计百分位时的抽样步长（整数影像始终用直方图精确计算），
+        默认内存影像不抽样，惰性影像按约400万像素抽样"""
         self.dictConvertedImages.clear()  # 清空之前的转换结果
 
         def convertImage(strImgName, objImageData):
-            npImageData = objImageData.npImageData
-
-            if len(npImageData.shape) == 3 and npImageData.shape[2] == 3:
-                rChannel = self._percentileStretch(npImageData[:, :, 0], dblPercentile)
-                gChannel = self._percentileStretch(npImageData[:, :, 1], dblPercentile)
-                bChannel = self._percentileStretch(npImageData[:, :, 2], dblPercentile)
-                npUint8ImageData = np.dstack((rChannel, gChannel, bChannel))
-            else:
-                npUint8ImageData = self._percentileStretch(npImageData, dblPercentile)
-                npUint8ImageData = np.stack((npUint8ImageData,) * 3, axis=-1)
+            intStep = intSampleStep
+            if intStep is None:
+                intStep = 1
+                if objImageData.isLazy:
+                    intPixels = objImageData.tupleOriginalShape[0] * objImageData.tupleOriginalShape[1]
+                    intStep = max(1, int(np.ceil(np.sqrt(intPixels / 4e6))))
+            objStretcher = PercentileStretcher(dblPercentile, intStep, objImageData.listNoData)
+
+            if objImageData.isLazy:
+                # 逐窗口累计统计量，拉伸作为窗口处理函数延迟到读取时执行
+                for intXOff, intYOff, intWidth, intHeight in objImageData.iterWindows():
+                    objStretcher.accumulate(objImageData.readWindow(intXOff, intYOff, intWidth, intHeight))
+                listWindowOps = objImageData.listWindowOps + [objStretcher.apply]
+                return ProcessedImageData(strImgName, None, objImageData.tupleOriginalShape, "converted",
+                                          objImageData.prj, objImageData.geoTransform, objImageData.isGdalRead,
+                                          objImageData.strSourcePath, listWindowOps)
 
-            return ProcessedImageData(strImgName, npUint8ImageData, objImageData.tupleOriginalShape, "converted",
-                                      objImageData.prj, objImageData.geoTransform, objImageData.isGdalRead)
+            npImageData = objImageData.npImageData
+            objStretcher.accumulate(npImageData)
+            return ProcessedImageData(strImgName, objStretcher.apply(npImageData), objImageData.tupleOriginalShape,
+                                      "converted", objImageData.prj, objImageData.geoTransform,
+                                      objImageData.isGdalRead)
 
         with ThreadPoolExecutor() as executor:
             futures = {executor.submit(convertImage, strImgName, objImageData): strImgName for
@@ -321,14 +856,6 @@ class ImageManager:
                 convertedImage = future.result()
                 self.dictConvertedImages[convertedImage.strImageName] = convertedImage
 
-    # 百分比拉伸（私有方法）
-    def _percentileStretch(self, npImageData, dblPercentile):
-        intLowerBound = np.percentile(npImageData, dblPercentile)
-        intUpperBound = np.percentile(npImageData, 100 - dblPercentile)
-        npClippedImageData = np.clip(npImageData, intLowerBound, intUpperBound)
-        npScaledImageData = (npClippedImageData - intLowerBound) / (intUpperBound - intLowerBound) * 255
-        return npScaledImageData.astype(np.uint8)
-
     # 赋予地理信息（公共方法）
     def assignGeoreference(self):
         if not self.dictImages:
@@ -363,8 +890,6 @@ class ImageManager:
                                                                  geoTransform, targetImageData.isGdalRead)
 
 
-
-
 # if __name__ == "__main__":
 
     # str_original_path = 'test.tif'
@@ -0,0 +1,111 @@
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import CancelledError
+
+
+class InferenceService:
+    """常驻预测进程池，代替每次请求打包ModelTrainer并启动新的Python进程
+
+    每个工作进程运行ModelTrainer/predict_worker.py，按(模型结构, 权重哈希)缓存最近使用的intModelCacheSize个模型，
+    通过标准输入输出逐行收发JSON任务。工作进程在第一次预测时启动，异常退出后自动重启。
+    """
+
+    def __init__(self, strTrainerDir="./utils/ModelTrainer", strAssetsDir="./assets/", strTempDir="./temp/",
+                 intWorkers=1, strDevice=None, intThreads=None, intInteropThreads=None, strPrecision='auto',
+                 intModelCacheSize=2):
+        self.strTrainerDir = os.path.abspath(strTrainerDir)
+        self.strAssetsDir = os.path.abspath(strAssetsDir)
+        self.strTempDir = os.path.abspath(strTempDir)
+        self.intWorkers = intWorkers
+        # 工作进程的推理设置，CPU线程默认在各工作进程间平分，避免相互争抢
+        self.dictWorkerEnv = {
+            "PREDICT_DEVICE": strDevice or "",
+            "PREDICT_THREADS": str(intThreads or max(1, (os.cpu_count() or 1) // intWorkers)),
+            "PREDICT_INTEROP_THREADS": str(intInteropThreads or ""),
+            "PREDICT_PRECISION": strPrecision,
+            "PREDICT_MODEL_CACHE": str(intModelCacheSize),  # 每个工作进程最多缓存的模型数
+        }
+        self.queueIdle = queue.Queue()  # 空闲的工作进程
+        self.listWorkers = []
+        self.lock = threading.Lock()
+
+    def _startWorker(self):
+        return subprocess.Popen([sys.executable, "predict_worker.py"], cwd=self.strTrainerDir, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, text=True, encoding="utf-8", bufsize=1,
+                                env=dict(os.environ, **self.dictWorkerEnv))
+
+    def _ensureWorkers(self):
+        with self.lock:
+            while len(self.listWorkers) < self.intWorkers:
+                worker = self._startWorker()
+                self.listWorkers.append(worker)
+                self.queueIdle.put(worker)
+
+    def _replaceWorker(self, worker):
+        # 工作进程已失效或任务被取消，换一个新进程
+        worker.kill()
+        worker.wait()
+        with self.lock:
+            self.listWorkers.remove(worker)
+            worker = self._startWorker()
+            self.listWorkers.append(worker)
+        return worker
+
+    def predict(self, config, strImagePath, funcProgress=None, eventCancel=None):
+        """阻塞执行一次预测，返回{"Mixture": 叠加图文件名, "Origin": 预测结果文件名}，结果位于strAssetsDir
+        funcProgress(阶段, 已完成数, 总数)接收工作进程报告的进度；eventCancel被设置后在下一条进度消息时
+        终止工作进程并抛出CancelledError"""
+        self._ensureWorkers()
+        os.makedirs(self.strTempDir, exist_ok=True)
+        strWorkDir = tempfile.mkdtemp(dir=self.strTempDir)
+        dictConfig = dict(config, FileName=os.path.abspath(strImagePath))
+        job = {"id": uuid.uuid4().hex, "config": dictConfig, "workDir": strWorkDir,
+               "weightsDir": self.strAssetsDir, "assetsDir": self.strAssetsDir}
+
+        worker = self.queueIdle.get()
+        try:
+            if eventCancel is not None and eventCancel.is_set():
+                raise CancelledError()
+            worker.stdin.write(json.dumps(job, ensure_ascii=False) + "\n")
+            worker.stdin.flush()
+            while True:
+                line = worker.stdout.readline()
+                if not line:
+                    raise RuntimeError("预测进程异常退出")
+                response = json.loads(line)
+                if "progress" not in response:
+                    break
+                if eventCancel is not None and eventCancel.is_set():
+                    worker = self._replaceWorker(worker)
+                    raise CancelledError()
+                if funcProgress is not None:
+                    funcProgress(response["progress"]["stage"], response["progress"]["done"],
+                                 response["progress"]["total"])
+        except (OSError, RuntimeError, ValueError):
+            worker = self._replaceWorker(worker)
+            raise
+        finally:
+            self.queueIdle.put(worker)
+            shutil.rmtree(strWorkDir, ignore_errors=True)
+
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def close(self):
+        with self.lock:
+            for worker in self.listWorkers:
+                worker.stdin.close()
+                try:
+                    worker.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+            self.listWorkers.clear()
+            self.queueIdle = queue.Queue()
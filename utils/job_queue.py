@@ -0,0 +1,138 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+
+class Job:
+    """一个异步任务的状态，由执行线程更新，接口线程读取"""
+
+    def __init__(self, strJobId, strKind):
+        self.strJobId = strJobId
+        self.strKind = strKind  # 任务类型（模型名），决定使用哪个并发池
+        self.strStatus = "queued"  # queued/running/succeeded/failed/cancelled
+        self.strStage = None
+        self.intDone = 0
+        self.intTotal = 0
+        self.result = None
+        self.strError = None
+        self.dblCreated = time.time()
+        self.dblFinished = None
+        self.intVersion = 0  # 状态每变化一次加1，推送进度时据此判断是否有新消息
+        self.eventCancel = threading.Event()
+        self.future = None
+        self.lock = threading.Lock()
+
+    @property
+    def isFinished(self):
+        return self.strStatus in ("succeeded", "failed", "cancelled")
+
+    def _update(self, **kwargs):
+        with self.lock:
+            for strKey, value in kwargs.items():
+                setattr(self, strKey, value)
+            self.intVersion += 1
+
+    def setProgress(self, strStage, intDone=0, intTotal=0):
+        """供任务函数调用，报告当前阶段和该阶段的完成数/总数"""
+        self._update(strStage=strStage, intDone=intDone, intTotal=intTotal)
+
+    def finish(self, strStatus, result=None, strError=None):
+        self._update(strStatus=strStatus, result=result, strError=strError, dblFinished=time.time())
+
+    def toDict(self):
+        with self.lock:
+            return {"job_id": self.strJobId, "kind": self.strKind, "status": self.strStatus, "stage": self.strStage,
+                    "done": self.intDone, "total": self.intTotal, "result": self.result, "error": self.strError,
+                    "created": self.dblCreated, "finished": self.dblFinished}
+
+
+class JobQueue:
+    """按任务类型分池执行的任务队列，每类任务的并发数由dictLimits限制（未列出的类型使用"default"）
+
+    任务函数以func(job, *args)的形式在后台线程中执行，通过job.setProgress报告进度，
+    应在job.eventCancel被设置后尽快抛出CancelledError。结束超过intKeepSeconds秒的任务会被清理。
+    """
+
+    def __init__(self, dictLimits=None, intKeepSeconds=3600):
+        self.dictLimits = {"default": 1}
+        self.dictLimits.update(dictLimits or {})
+        self.intKeepSeconds = intKeepSeconds
+        self.dictExecutors = {}
+        self.dictJobs = {}
+        self.lock = threading.Lock()
+
+    def _getExecutor(self, strKind):
+        strPool = strKind if strKind in self.dictLimits else "default"
+        if strPool not in self.dictExecutors:
+            self.dictExecutors[strPool] = ThreadPoolExecutor(max_workers=self.dictLimits[strPool],
+                                                             thread_name_prefix=f"job-{strPool}")
+        return self.dictExecutors[strPool]
+
+    def _purge(self):
+        dblNow = time.time()
+        for strJobId in [strJobId for strJobId, job in self.dictJobs.items()
+                         if job.isFinished and dblNow - job.dblFinished > self.intKeepSeconds]:
+            del self.dictJobs[strJobId]
+
+    def submit(self, strKind, func, *args):
+        """提交任务并立即返回Job，任务在对应类型的线程池中排队执行"""
+        job = Job(uuid.uuid4().hex, strKind)
+        with self.lock:
+            self._purge()
+            self.dictJobs[job.strJobId] = job
+            job.future = self._getExecutor(strKind).submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        if job.eventCancel.is_set():
+            job.finish("cancelled")
+            return
+        job._update(strStatus="running")
+        try:
+            result = func(job, *args)
+        except CancelledError:
+            job.finish("cancelled")
+        except Exception as e:
+            print(f"任务{job.strJobId}失败: {e}")
+            job.finish("failed", strError=str(e))
+        else:
+            job.finish("succeeded", result)
+
+    def get(self, strJobId):
+        with self.lock:
+            return self.dictJobs.get(strJobId)
+
+    def cancel(self, strJobId):
+        """取消任务：排队中的任务直接取消，运行中的任务由任务函数在下一个检查点结束；任务不存在时返回None"""
+        job = self.get(strJobId)
+        if job is None:
+            return None
+        if not job.isFinished:
+            job.eventCancel.set()
+            if job.future.cancel():
+                job.finish("cancelled")
+        return job
+
+    async def iterEvents(self, job, dblInterval=0.5):
+        """以Server-Sent Events格式持续推送任务状态，任务结束后推送最后一条并停止"""
+        intVersion = -1
+        while True:
+            if job.intVersion != intVersion:
+                intVersion = job.intVersion
+                dictState = job.toDict()
+                isEnd = dictState["status"] in ("succeeded", "failed", "cancelled")
+                strData = json.dumps(dictState, ensure_ascii=False)
+                yield f"event: {'end' if isEnd else 'progress'}\ndata: {strData}\n\n"
+                if isEnd:
+                    return
+            await asyncio.sleep(dblInterval)
+
+    def shutdown(self):
+        with self.lock:
+            for job in self.dictJobs.values():
+                job.eventCancel.set()
+            for executor in self.dictExecutors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+
+def _jsonDefault(value):
+    # numpy标量等无法直接序列化的统计值
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class ResultCache:
+    """按内容寻址的预测结果缓存，键为(源影像内容哈希, 模型名, 权重哈希, 提取类型, 切片参数等)的哈希
+
+    每个条目是strCacheDir下的一个目录，保存_ori/_mix结果文件和meta.json（结果文件名、掩膜统计信息）。
+    条目总大小超过intBudgetBytes时按最近使用时间淘汰。文件哈希按(路径, 修改时间, 大小)缓存，同一文件只读一次。
+    """
+
+    def __init__(self, strCacheDir="./assets/.result_cache", intBudgetBytes=2 * 1024 ** 3, funcRelease=None):
+        self.strCacheDir = strCacheDir
+        self.intBudgetBytes = intBudgetBytes
+        self.funcRelease = funcRelease  # funcRelease(路径)在恢复结果文件覆盖目标前释放其他模块打开的句柄
+        self.dictEntries = OrderedDict()  # 键 -> 条目大小（字节），按最近使用排序
+        self.intTotalBytes = 0
+        self.dictFileHashes = {}  # (绝对路径, 修改时间, 大小) -> 内容哈希
+        self.dictMaskIndex = {}  # 结果掩膜内容哈希 -> 键，用于查找缓存的统计信息
+        self.lock = threading.Lock()
+        os.makedirs(self.strCacheDir, exist_ok=True)
+        self._loadIndex()
+
+    def _loadIndex(self):
+        # 启动时按meta.json的修改时间（即最近使用时间）恢复LRU顺序
+        listEntries = []
+        for strKey in os.listdir(self.strCacheDir):
+            strMetaPath = os.path.join(self.strCacheDir, strKey, "meta.json")
+            if strKey.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.strCacheDir, strKey), ignore_errors=True)
+                continue
+            try:
+                with open(strMetaPath, 'r', encoding='utf-8') as f:
+                    dictMeta = json.load(f)
+                listEntries.append((os.path.getmtime(strMetaPath), strKey, dictMeta))
+            except (OSError, ValueError):
+                # 写入中断的条目直接删除
+                shutil.rmtree(os.path.join(self.strCacheDir, strKey), ignore_errors=True)
+        for _, strKey, dictMeta in sorted(listEntries):
+            self.dictEntries[strKey] = dictMeta["size"]
+            self.intTotalBytes += dictMeta["size"]
+            if dictMeta.get("maskHash"):
+                self.dictMaskIndex[dictMeta["maskHash"]] = strKey
+
+    def fileHash(self, strPath):
+        stat = os.stat(strPath)
+        tupleKey = (os.path.abspath(strPath), stat.st_mtime_ns, stat.st_size)
+        strHash = self.dictFileHashes.get(tupleKey)
+        if strHash is None:
+            sha1 = hashlib.sha1()
+            with open(strPath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+            strHash = self.dictFileHashes[tupleKey] = sha1.hexdigest()
+        return strHash
+
+    def makeKey(self, strSourcePath, listWeightsPaths, dictParams):
+        """由源影像、权重文件（可为空列表）和其他影响结果的参数生成缓存键"""
+        dictKey = {
+            "source": self.fileHash(strSourcePath),
+            "weights": [self.fileHash(strPath) for strPath in sorted(listWeightsPaths)],
+            "params": dictParams,
+        }
+        return hashlib.sha1(json.dumps(dictKey, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _restore(self, strSrc, strDst):
+        # 目标文件与缓存文件大小和修改时间相同时说明未被覆盖，不再复制
+        statSrc = os.stat(strSrc)
+        if os.path.exists(strDst):
+            statDst = os.stat(strDst)
+            if (statDst.st_size, statDst.st_mtime_ns) == (statSrc.st_size, statSrc.st_mtime_ns):
+                return
+        strTemp = f"{strDst}.{threading.get_ident()}.tmp"
+        shutil.copy2(strSrc, strTemp)
+        if self.funcRelease is not None:
+            self.funcRelease(strDst)
+        os.replace(strTemp, strDst)
+
+    def get(self, strKey, strOutputDir):
+        """命中时把结果文件恢复到strOutputDir并返回{"Mixture": ..., "Origin": ...}，未命中返回None"""
+        with self.lock:
+            if strKey not in self.dictEntries:
+                return None
+            self.dictEntries.move_to_end(strKey)
+        strEntryDir = os.path.join(self.strCacheDir, strKey)
+        strMetaPath = os.path.join(strEntryDir, "meta.json")
+        try:
+            with open(strMetaPath, 'r', encoding='utf-8') as f:
+                dictMeta = json.load(f)
+            for strName in dictMeta["result"].values():
+                self._restore(os.path.join(strEntryDir, strName), os.path.join(strOutputDir, strName))
+            os.utime(strMetaPath)  # 记录最近使用时间
+        except (OSError, ValueError, KeyError):
+            # 条目已损坏，当作未命中并删除
+            self._remove(strKey)
+            return None
+        return dictMeta["result"]
+
+    def put(self, strKey, strOutputDir, dictResult):
+        """把strOutputDir中的结果文件（dictResult的值）复制进缓存，超出预算时淘汰最久未使用的条目"""
+        strEntryDir = os.path.join(self.strCacheDir, strKey)
+        strTempDir = f"{strEntryDir}.{threading.get_ident()}.tmp"
+        shutil.rmtree(strTempDir, ignore_errors=True)
+        os.makedirs(strTempDir)
+        intSize = 0
+        for strName in dictResult.values():
+            shutil.copy2(os.path.join(strOutputDir, strName), os.path.join(strTempDir, strName))
+            intSize += os.path.getsize(os.path.join(strTempDir, strName))
+        strMaskHash = self.fileHash(os.path.join(strOutputDir, dictResult["Origin"]))
+        dictMeta = {"result": dictResult, "size": intSize, "maskHash": strMaskHash, "stats": None,
+                    "created": time.time()}
+        with open(os.path.join(strTempDir, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(dictMeta, f, ensure_ascii=False)
+
+        with self.lock:
+            if strKey in self.dictEntries:
+                # 并发请求已写入同一条目
+                shutil.rmtree(strTempDir, ignore_errors=True)
+                return
+            os.replace(strTempDir, strEntryDir)
+            self.dictEntries[strKey] = intSize
+            self.intTotalBytes += intSize
+            self.dictMaskIndex[strMaskHash] = strKey
+            while self.intTotalBytes > self.intBudgetBytes and len(self.dictEntries) > 1:
+                strOldKey = next(iter(self.dictEntries))
+                self._removeLocked(strOldKey)
+
+    def _removeLocked(self, strKey):
+        intSize = self.dictEntries.pop(strKey, None)
+        if intSize is not None:
+            self.intTotalBytes -= intSize
+        for strMaskHash in [k for k, v in self.dictMaskIndex.items() if v == strKey]:
+            del self.dictMaskIndex[strMaskHash]
+        shutil.rmtree(os.path.join(self.strCacheDir, strKey), ignore_errors=True)
+
+    def _remove(self, strKey):
+        with self.lock:
+            self._removeLocked(strKey)
+
+    def getMaskStats(self, strMaskPath, funcAnalyze):
+        """返回掩膜统计信息：掩膜是缓存中的预测结果且已统计过时直接读取，否则调用funcAnalyze()计算并存入缓存"""
+        strMaskHash = self.fileHash(strMaskPath)
+        with self.lock:
+            strKey = self.dictMaskIndex.get(strMaskHash)
+        strMetaPath = None if strKey is None else os.path.join(self.strCacheDir, strKey, "meta.json")
+        dictMeta = None
+        if strMetaPath is not None:
+            try:
+                with open(strMetaPath, 'r', encoding='utf-8') as f:
+                    dictMeta = json.load(f)
+                if dictMeta.get("stats") is not None:
+                    return dictMeta["stats"]
+            except (OSError, ValueError):
+                dictMeta = None
+
+        stats = funcAnalyze()
+        if dictMeta is not None:
+            dictMeta["stats"] = json.loads(json.dumps(stats, default=_jsonDefault))
+            strTempPath = f"{strMetaPath}.{threading.get_ident()}.tmp"
+            with open(strTempPath, 'w', encoding='utf-8') as f:
+                json.dump(dictMeta, f, ensure_ascii=False)
+            os.replace(strTempPath, strMetaPath)
+        return stats
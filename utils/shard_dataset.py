@@ -0,0 +1,207 @@
+"""预切片训练数据：把(影像, 标签)切片打包成定长uint8 .npy分片，训练时用np.memmap随机读取，不再逐轮解码PNG/JPG
+
+目录结构：
+    index.json                   {"version", "image_shape": [H, W, C], "label_shape": [H, W], "count", "shards": [...]}
+    shard_00000_images.npy       (n, H, W, C) uint8
+    shard_00000_labels.npy       (n, H, W) uint8
+各DataLoader加载进程分别打开内存映射，数据经操作系统页缓存共享，不在进程间复制。
+
+打包：
+    python -m utils.shard_dataset --out dataset/shards/train --list train.txt
+    python -m utils.shard_dataset --out dataset/shards/train --image a.tif --label a_label.tif --binary-label
+"""
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data.dataset import Dataset
+
+from utils.dataset import read_txt
+
+INDEX_NAME = "index.json"
+
+
+class ShardWriter:
+    """按intTilesPerShard个切片一个分片写出，切片尺寸以第一个切片为准，尺寸不同的切片跳过"""
+
+    def __init__(self, strOutDir, intTilesPerShard=1024):
+        self.strOutDir = strOutDir
+        self.intTilesPerShard = intTilesPerShard
+        self.tupleImageShape = None
+        self.tupleLabelShape = None
+        self.listShards = []
+        self.npImages = None  # 当前分片的内存映射
+        self.npLabels = None
+        self.intFilled = 0
+        self.intSkipped = 0
+        os.makedirs(strOutDir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # 打包中途出错时不写索引，目录不会被当作完整的分片数据
+        if excType is None:
+            self.close()
+
+    def _shardPaths(self, intShard):
+        return (f"shard_{intShard:05d}_images.npy", f"shard_{intShard:05d}_labels.npy")
+
+    def _openShard(self):
+        strImages, strLabels = self._shardPaths(len(self.listShards))
+        self.npImages = np.lib.format.open_memmap(os.path.join(self.strOutDir, strImages), mode='w+', dtype=np.uint8,
+                                                  shape=(self.intTilesPerShard,) + self.tupleImageShape)
+        self.npLabels = np.lib.format.open_memmap(os.path.join(self.strOutDir, strLabels), mode='w+', dtype=np.uint8,
+                                                  shape=(self.intTilesPerShard,) + self.tupleLabelShape)
+        self.intFilled = 0
+
+    def _closeShard(self):
+        if self.npImages is None:
+            return
+        strImages, strLabels = self._shardPaths(len(self.listShards))
+        if self.intFilled < self.intTilesPerShard:
+            # 最后一个分片按实际数量重写，文件中不留空切片
+            for strName, strAttr in ((strImages, 'npImages'), (strLabels, 'npLabels')):
+                strPath = os.path.join(self.strOutDir, strName)
+                np.save(strPath + '.tmp.npy', getattr(self, strAttr)[:self.intFilled])
+                setattr(self, strAttr, None)  # 先释放内存映射，Windows上才能替换文件
+                os.replace(strPath + '.tmp.npy', strPath)
+        self.npImages = self.npLabels = None  # 释放内存映射即写回磁盘
+        self.listShards.append({"images": strImages, "labels": strLabels, "count": self.intFilled})
+
+    def add(self, npImage, npLabel):
+        """npImage为(H, W, C) RGB，npLabel为(H, W)类别图，都按uint8保存"""
+        if npLabel.ndim == 3:
+            npLabel = npLabel[:, :, 0]
+        if self.tupleImageShape is None:
+            self.tupleImageShape, self.tupleLabelShape = npImage.shape, npLabel.shape
+        if npImage.shape != self.tupleImageShape or npLabel.shape != self.tupleLabelShape:
+            self.intSkipped += 1
+            return
+        if self.npImages is None:
+            self._openShard()
+        self.npImages[self.intFilled] = npImage
+        self.npLabels[self.intFilled] = npLabel
+        self.intFilled += 1
+        if self.intFilled == self.intTilesPerShard:
+            self._closeShard()
+
+    def close(self):
+        self._closeShard()
+        dictIndex = {"version": 1, "image_shape": list(self.tupleImageShape or ()),
+                     "label_shape": list(self.tupleLabelShape or ()),
+                     "count": sum(dictShard["count"] for dictShard in self.listShards), "shards": self.listShards}
+        with open(os.path.join(self.strOutDir, INDEX_NAME), 'w', encoding='utf-8') as f:
+            json.dump(dictIndex, f, ensure_ascii=False, indent=2)
+        print("打包了{}个切片，共{}个分片{}".format(dictIndex["count"], len(self.listShards),
+                                          "，{}个尺寸不一致的切片被跳过".format(self.intSkipped)
+                                          if self.intSkipped else ""))
+        return dictIndex
+
+
+def packList(strListPath, writer):
+    """打包Dataset使用的"影像\\t标签"列表（路径相对dataset/），影像按PIL读取为RGB，与Dataset一致"""
+    listImages, listLabels = read_txt(strListPath)
+    for strImage, strLabel in zip(listImages, listLabels):
+        writer.add(np.asarray(Image.open(strImage).convert('RGB')), np.asarray(Image.open(strLabel)))
+
+
+def packGeoTiffPair(strImagePath, strLabelPath, writer, intTileSize=512, intStep=512, isBinaryLabel=False):
+    """按ImageManager.cropImg的切片方式同时裁剪影像和标签并打包
+    影像与预测时一样按全局最值归一化到uint8，标签保持原值；isBinaryLabel为True时非零值记为类别1（0/255掩膜）"""
+    from utils.geo_utils import ImageManager
+
+    imageManager, labelManager = ImageManager(), ImageManager()
+    imageManager.readImg(strImagePath)
+    labelManager.readImg(strLabelPath, strNormalize='native')
+    if not imageManager.dictImages or not labelManager.dictImages:
+        print(f"Failed to read image pair: {strImagePath}, {strLabelPath}")
+        return
+    tupleImageShape = next(iter(imageManager.dictImages.values())).tupleOriginalShape[:2]
+    tupleLabelShape = next(iter(labelManager.dictImages.values())).tupleOriginalShape[:2]
+    if tupleImageShape != tupleLabelShape:
+        print(f"Image and label sizes differ: {tupleImageShape} vs {tupleLabelShape}")
+        return
+
+    # iterCrops即cropImg的逐块版本，切片名和补零方式相同，不在内存中保留全部切片
+    for (_, _, _, objImageCrop), (_, _, _, objLabelCrop) in zip(
+            imageManager.iterCrops(intTileSize, intTileSize, intStep),
+            labelManager.iterCrops(intTileSize, intTileSize, intStep)):
+        npImage = objImageCrop.npImageData
+        if npImage.ndim == 3 and npImage.shape[2] == 1:
+            npImage = npImage[:, :, 0]
+        if npImage.ndim == 2:
+            npImage = np.repeat(npImage[:, :, None], 3, axis=2)
+        elif not objImageCrop.isGdalRead:
+            npImage = cv2.cvtColor(npImage[:, :, :3], cv2.COLOR_BGR2RGB)
+        npLabel = objLabelCrop.npImageData
+        npLabel = npLabel[:, :, 0] if npLabel.ndim == 3 else npLabel
+        npLabel = (npLabel > 0) if isBinaryLabel else npLabel
+        writer.add(npImage[:, :, :3].astype(np.uint8), npLabel.astype(np.uint8))
+
+
+class ShardDataset(Dataset):
+    """从分片目录随机读取切片，不解码、不复制：返回(3, H, W) uint8影像和(H, W) uint8标签，
+    归一化和类型转换在训练循环中搬运到设备后进行。transform不为空时对(H, W, 3)影像调用transform（与Dataset相同）"""
+
+    def __init__(self, strShardDir, transform=None):
+        super().__init__()
+        self.strShardDir = strShardDir
+        self.transform = transform
+        with open(os.path.join(strShardDir, INDEX_NAME), 'r', encoding='utf-8') as f:
+            self.dictIndex = json.load(f)
+        self.npEnds = np.cumsum([dictShard["count"] for dictShard in self.dictIndex["shards"]])
+        self.listArrays = None  # 每个加载进程第一次读取时打开内存映射
+
+    def __getstate__(self):
+        # 内存映射不随数据集传给加载进程，否则会整份复制
+        dictState = self.__dict__.copy()
+        dictState["listArrays"] = None
+        return dictState
+
+    def _open(self):
+        # 写时复制模式：数组可写（torch.from_numpy不告警），未写入的页与其他进程共享
+        self.listArrays = [(np.load(os.path.join(self.strShardDir, dictShard["images"]), mmap_mode='c'),
+                            np.load(os.path.join(self.strShardDir, dictShard["labels"]), mmap_mode='c'))
+                           for dictShard in self.dictIndex["shards"]]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if self.listArrays is None:
+            self._open()
+        intShard = int(np.searchsorted(self.npEnds, index, side='right'))
+        intLocal = index - (int(self.npEnds[intShard - 1]) if intShard else 0)
+        npImages, npLabels = self.listArrays[intShard]
+        label = torch.from_numpy(npLabels[intLocal])
+        if self.transform is not None:
+            return self.transform(npImages[intLocal]).float(), label.long()
+        return torch.from_numpy(npImages[intLocal]).permute(2, 0, 1), label
+
+    def __len__(self):
+        return int(self.dictIndex["count"])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="把训练切片打包成内存映射分片")
+    parser.add_argument('--out', required=True, help="分片目录")
+    parser.add_argument('--list', nargs='*', default=[], help="Dataset格式的数据列表")
+    parser.add_argument('--image', nargs='*', default=[], help="带标签的GeoTIFF影像，与--label一一对应")
+    parser.add_argument('--label', nargs='*', default=[])
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--step', type=int, default=512, help="裁剪步长，等于切片大小时切片不重叠")
+    parser.add_argument('--binary-label', action='store_true', help="标签中非零值记为类别1")
+    parser.add_argument('--tiles-per-shard', type=int, default=1024)
+    args = parser.parse_args()
+    if len(args.image) != len(args.label):
+        parser.error("--image与--label数量不一致")
+
+    with ShardWriter(args.out, args.tiles_per_shard) as shardWriter:
+        for strListPath in args.list:
+            packList(strListPath, shardWriter)
+        for strImagePath, strLabelPath in zip(args.image, args.label):
+            packGeoTiffPair(strImagePath, strLabelPath, shardWriter, args.tile_size, args.step, args.binary_label)
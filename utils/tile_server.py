@@ -0,0 +1,165 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from osgeo import gdal
+
+# 与ImageManager共用按线程缓存的只读句柄，文件被覆盖或替换前统一释放
+from .geo_utils import _openDataset
+
+gdal.UseExceptions()
+
+
+class TileServer:
+    """按像素坐标金字塔切片（与Leaflet的CRS.Simple一致），z=intMaxZoom为原始分辨率，每降一级分辨率减半
+
+    降采样数据直接从影像金字塔读取，缺少金字塔时首次访问自动建立(.ovr)。
+    切片先查内存LRU缓存，再查按文件修改时间区分的磁盘缓存，都没有时才读取影像渲染。
+    """
+
+    def __init__(self, strRootDirectory="./assets/", intTileSize=256, intCacheBytes=64 * 1024 ** 2,
+                 strCacheDirectory=None):
+        self.strRootDirectory = strRootDirectory
+        self.intTileSize = intTileSize
+        self.intCacheBytes = intCacheBytes  # 内存缓存上限（字节）
+        self.strCacheDirectory = strCacheDirectory or os.path.join(strRootDirectory, ".tile_cache")
+        self.dictCache = OrderedDict()  # (文件名, 修改时间, z, x, y, 格式) -> 编码后的切片
+        self.intCachedBytes = 0
+        self.dictInfo = {}  # (文件名, 修改时间) -> 影像信息
+        self.dictInfoLocks = {}
+        self.lock = threading.Lock()
+
+    def _resolvePath(self, strFileName):
+        # 只允许访问根目录下的文件
+        if os.path.basename(strFileName) != strFileName:
+            raise FileNotFoundError(strFileName)
+        strPath = os.path.join(self.strRootDirectory, strFileName)
+        return strPath, os.stat(strPath).st_mtime_ns
+
+    def getInfo(self, strFileName):
+        """返回影像尺寸、切片大小和最大缩放级别，首次访问时建立金字塔并统计拉伸范围"""
+        strPath, intMtime = self._resolvePath(strFileName)
+        tupleKey = (strFileName, intMtime)
+        with self.lock:
+            dictInfo = self.dictInfo.get(tupleKey)
+            if dictInfo is not None:
+                return dictInfo
+            lockInfo = self.dictInfoLocks.setdefault(tupleKey, threading.Lock())
+
+        with lockInfo:
+            if tupleKey in self.dictInfo:
+                return self.dictInfo[tupleKey]
+
+            dataset = gdal.Open(strPath)
+            intWidth, intHeight = dataset.RasterXSize, dataset.RasterYSize
+            intMaxZoom = max(0, int(np.ceil(np.log2(max(intWidth, intHeight) / self.intTileSize))))
+            if intMaxZoom > 0 and dataset.GetRasterBand(1).GetOverviewCount() == 0:
+                dataset.BuildOverviews('AVERAGE', [2 ** i for i in range(1, intMaxZoom + 1)])
+            dataset = None
+
+            # 非8位影像按波段近似最值拉伸，保证各切片颜色一致
+            dataset = _openDataset(strPath)
+            listBands = [1, 2, 3] if dataset.RasterCount >= 3 else [1]
+            listRanges = None
+            if dataset.GetRasterBand(1).DataType != gdal.GDT_Byte:
+                listRanges = [dataset.GetRasterBand(i).ComputeRasterMinMax(True) for i in listBands]
+
+            dictInfo = {"width": intWidth, "height": intHeight, "tileSize": self.intTileSize,
+                        "maxZoom": intMaxZoom, "bands": listBands, "ranges": listRanges}
+            with self.lock:
+                # 同一文件只保留最新版本的信息和磁盘缓存
+                for tupleOld in [k for k in self.dictInfo if k[0] == strFileName]:
+                    del self.dictInfo[tupleOld]
+                    self.dictInfoLocks.pop(tupleOld, None)
+                self.dictInfo[tupleKey] = dictInfo
+            strFileCache = os.path.join(self.strCacheDirectory, strFileName)
+            if os.path.isdir(strFileCache):
+                for strVersion in os.listdir(strFileCache):
+                    if strVersion != str(intMtime):
+                        shutil.rmtree(os.path.join(strFileCache, strVersion), ignore_errors=True)
+            return dictInfo
+
+    def _renderTile(self, strPath, intMtime, dictInfo, z, x, y, strFormat):
+        if not 0 <= z <= dictInfo["maxZoom"] or x < 0 or y < 0:
+            return None
+        intScale = 1 << (dictInfo["maxZoom"] - z)
+        intSpan = self.intTileSize * intScale  # 切片覆盖的原始像素数
+        intXOff, intYOff = x * intSpan, y * intSpan
+        if intXOff >= dictInfo["width"] or intYOff >= dictInfo["height"]:
+            return None
+
+        # 边缘切片只读取影像范围内的部分，其余透明
+        intWinWidth = min(intSpan, dictInfo["width"] - intXOff)
+        intWinHeight = min(intSpan, dictInfo["height"] - intYOff)
+        intBufWidth = max(1, round(intWinWidth / intScale))
+        intBufHeight = max(1, round(intWinHeight / intScale))
+        dataset = _openDataset(strPath)
+
+        npTile = np.zeros((self.intTileSize, self.intTileSize, 4), dtype=np.uint8)
+        for i, intBand in enumerate(dictInfo["bands"]):
+            npBand = dataset.GetRasterBand(intBand).ReadAsArray(intXOff, intYOff, intWinWidth, intWinHeight,
+                                                                buf_xsize=intBufWidth, buf_ysize=intBufHeight)
+            if dictInfo["ranges"] is not None:
+                dblMin, dblMax = dictInfo["ranges"][i]
+                npBand = npBand.astype(np.float32)
+                npBand -= dblMin
+                npBand *= 255 / (dblMax - dblMin) if dblMax > dblMin else 0
+                npBand = np.clip(npBand, 0, 255, out=npBand).astype(np.uint8)
+            npTile[:intBufHeight, :intBufWidth, i] = npBand
+        if len(dictInfo["bands"]) == 1:
+            npTile[:, :, 1] = npTile[:, :, 2] = npTile[:, :, 0]
+        # 掩膜带同时处理nodata和alpha波段
+        npTile[:intBufHeight, :intBufWidth, 3] = dataset.GetRasterBand(1).GetMaskBand().ReadAsArray(
+            intXOff, intYOff, intWinWidth, intWinHeight, buf_xsize=intBufWidth, buf_ysize=intBufHeight)
+
+        npTile = npTile[:, :, [2, 1, 0, 3]]  # OpenCV按BGRA编码
+        if strFormat == 'webp':
+            _, npEncoded = cv2.imencode('.webp', npTile, [cv2.IMWRITE_WEBP_QUALITY, 90])
+        else:
+            _, npEncoded = cv2.imencode('.png', npTile, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return npEncoded.tobytes()
+
+    def _putCache(self, tupleKey, bytesTile):
+        with self.lock:
+            if tupleKey in self.dictCache:
+                return
+            self.dictCache[tupleKey] = bytesTile
+            self.intCachedBytes += len(bytesTile)
+            while self.intCachedBytes > self.intCacheBytes and self.dictCache:
+                _, bytesOld = self.dictCache.popitem(last=False)
+                self.intCachedBytes -= len(bytesOld)
+
+    def getTile(self, strFileName, z, x, y, strFormat='png'):
+        """返回编码后的切片，超出影像范围时返回None"""
+        strPath, intMtime = self._resolvePath(strFileName)
+        tupleKey = (strFileName, intMtime, z, x, y, strFormat)
+        with self.lock:
+            bytesTile = self.dictCache.get(tupleKey)
+            if bytesTile is not None:
+                self.dictCache.move_to_end(tupleKey)
+                return bytesTile
+
+        strCachePath = os.path.join(self.strCacheDirectory, strFileName, str(intMtime), str(z), str(x),
+                                    f"{y}.{strFormat}")
+        if os.path.exists(strCachePath):
+            with open(strCachePath, 'rb') as f:
+                bytesTile = f.read()
+            self._putCache(tupleKey, bytesTile)
+            return bytesTile
+
+        dictInfo = self.getInfo(strFileName)
+        bytesTile = self._renderTile(strPath, intMtime, dictInfo, z, x, y, strFormat)
+        if bytesTile is None:
+            return None
+
+        # 先写临时文件再改名，避免并发请求读到不完整的切片
+        os.makedirs(os.path.dirname(strCachePath), exist_ok=True)
+        strTempPath = f"{strCachePath}.{threading.get_ident()}.tmp"
+        with open(strTempPath, 'wb') as f:
+            f.write(bytesTile)
+        os.replace(strTempPath, strCachePath)
+        self._putCache(tupleKey, bytesTile)
+        return bytesTile